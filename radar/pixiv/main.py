@@ -1,5 +1,5 @@
 from pathlib import Path
-from pixivpy3 import AppPixivAPI
+from pixivpy3 import AppPixivAPI, PixivError
 
 def to_jxl(path: Path):
     import subprocess
@@ -12,16 +12,123 @@ def to_jxl(path: Path):
     ], stderr=subprocess.DEVNULL)
     assert ret.returncode == 0
 
+class JxlConverter:
+    def __init__(self, threads, max_pending_bytes):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from tqdm import tqdm
+        self.exe = ThreadPoolExecutor(threads)
+        self.max_pending_bytes = max_pending_bytes
+        self.pending_bytes = 0
+        self.cond = threading.Condition()
+        self.progress = tqdm(desc='JXL', total=0, position=1)
+
+    def wait(self):
+        # Downloads stall while too many unconverted files are on disk
+        with self.cond:
+            self.cond.wait_for(lambda: self.pending_bytes < self.max_pending_bytes)
+
+    def submit(self, path: Path):
+        size = path.stat().st_size
+        with self.cond:
+            self.pending_bytes += size
+        self.progress.total += 1
+        self.progress.refresh()
+        return self.exe.submit(self.convert, path, size)
+
+    def convert(self, path: Path, size):
+        try:
+            to_jxl(path)
+            path.unlink()
+        except Exception as e:
+            # The post is fetched again next run, so no source is left behind
+            path.unlink(missing_ok=True)
+            path.with_suffix('.jxl').unlink(missing_ok=True)
+            self.progress.write(f'Failed to convert {path}: {e!r}')
+            raise
+        finally:
+            with self.cond:
+                self.pending_bytes -= size
+                self.cond.notify_all()
+            self.progress.update()
+
+    def close(self):
+        self.exe.shutdown()
+        self.progress.close()
+
+def download_file(api: AppPixivAPI, url, save_path: Path, retries=3):
+    import os
+    import time
+    import requests
+    # Images only become visible under their real name once complete,
+    # so an interrupted run never leaves a truncated file behind
+    tmp_path = save_path.with_name(save_path.name + '.part')
+    for attempt in range(retries + 1):
+        try:
+            with api.requests_call('GET', url, headers={'Referer': 'https://app-api.pixiv.net/'}, stream=True) as res:
+                res.raise_for_status()
+                with open(tmp_path, 'wb') as f:
+                    for chunk in res.iter_content(1 << 16):
+                        f.write(chunk)
+            os.replace(tmp_path, save_path)
+            return
+        except (requests.RequestException, PixivError):
+            tmp_path.unlink(missing_ok=True)
+            if attempt == retries:
+                raise
+            time.sleep(2 ** attempt)
+
+def write_if_changed(path: Path, content: str):
+    data = content.encode('utf-8')
+    if path.exists() and path.stat().st_size == len(data) and path.read_bytes() == data:
+        return False
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    import os
+    os.replace(tmp_path, path)
+    return True
+
 def get_url_filename(url):
     from urllib.parse import urlparse
     return Path(urlparse(url).path).name
 
 class PixivRepo:
-    def __init__(self, path, api: AppPixivAPI):
+    def __init__(self, path, api: AppPixivAPI, converter: JxlConverter, threads=8):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
         self.base_path = Path(path)
         self.api = api
+        self.converter = converter
         self.post_list = []
-        self.convert_list = []
+        self.exe = ThreadPoolExecutor(threads)
+        self.slots = threading.BoundedSemaphore(threads * 2)
+        self.downloads = []
+        self.conversions = []
+        self.touched_dirs = set()
+        self.state_path = self.base_path / '.sync.json'
+        self.state = self.load_state()
+
+    def load_state(self):
+        import json
+        if self.state_path.exists():
+            with open(self.state_path, 'r') as f:
+                return json.load(f)
+        return {'cursor': None, 'last_full': None, 'authors': {}}
+
+    def save_state(self):
+        import os
+        import json
+        self.base_path.mkdir(exist_ok=True, parents=True)
+        tmp_path = self.state_path.with_name(self.state_path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def need_full(self, interval):
+        import time
+        last_full = self.state['last_full']
+        return last_full is None or time.time() - last_full > interval
 
     @staticmethod
     def extract_urls(data):
@@ -43,10 +150,51 @@ class PixivRepo:
     def download_img(self, data, url):
         save_path = self.get_img_save_dir(data) / get_url_filename(url)
         save_path.parent.mkdir(exist_ok=True, parents=True)
-        with open(save_path, 'wb') as f:
-            self.api.download(url, fname=f)
+        self.converter.wait()
+        download_file(self.api, url, save_path)
         if save_path.suffix != '.jxl':
-            self.convert_list.append(save_path)
+            self.conversions.append((data, save_path, self.converter.submit(save_path)))
+
+    def submit_download(self, data, url):
+        # Bound the queue so that the bookmark iterator does not run far ahead
+        self.slots.acquire()
+        future = self.exe.submit(self.download_img, data, url)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.downloads.append((data, url, future))
+
+    def wait_downloads(self):
+        self.exe.shutdown()
+        failed = set()
+        for data, url, future in self.downloads:
+            try:
+                future.result()
+            except Exception as e:
+                print(f'Failed to download {url}: {e!r}')
+                failed.add(id(data))
+        self.downloads = []
+        # Every conversion is submitted by a download, so all are queued now
+        self.converter.close()
+        for data, path, future in self.conversions:
+            if future.exception() is not None:
+                failed.add(id(data))
+        self.conversions = []
+        # Posts with missing pages get no JSON, so the next run fetches them
+        # again. A changed post has lost its old pages already, so its old
+        # JSON is dropped as well.
+        for data in self.post_list:
+            if id(data) in failed:
+                self.forget_post(data)
+        self.post_list = [data for data in self.post_list if id(data) not in failed]
+        return len(failed)
+
+    def forget_post(self, data):
+        self.get_json_save_path(data).unlink(missing_ok=True)
+        author_id = str(data['user']['id'])
+        entry = self.state['authors'].get(author_id)
+        if entry is not None and data['id'] in entry['posts']:
+            entry['posts'].remove(data['id'])
+            if not entry['posts']:
+                del self.state['authors'][author_id]
 
     def handle_post(self, data):
         img_type = data['type']
@@ -71,19 +219,24 @@ class PixivRepo:
                 skip_download = True
             else:
                 for url in old_url_list:
-                    (self.get_img_save_dir(data) / get_url_filename(url)).with_suffix('.jxl').unlink()
+                    (self.get_img_save_dir(data) / get_url_filename(url)).with_suffix('.jxl').unlink(missing_ok=True)
         self.post_list.append(data)
+        self.touched_dirs.add(self.get_img_save_dir(data))
         if skip_download:
             return
         for url in url_list:
-            self.download_img(data, url)
+            self.submit_download(data, url)
 
-    def remove_all_files_with_suffix(self, suf):
+    def remove_stale(self, keep):
         import os
+        removed = 0
         for root, dirs, files in os.walk(self.base_path):
             for name in files:
-                if name.endswith(suf):
-                    os.remove(os.path.join(root, name))
+                path = Path(root) / name
+                if name.endswith(('.json', '.md')) and path not in keep and path != self.state_path:
+                    path.unlink()
+                    removed += 1
+        return removed
 
     @staticmethod
     def gen_author_readme(info, posts):
@@ -107,10 +260,8 @@ class PixivRepo:
 
     def gen_overall_readme(self, authors):
         from collections import defaultdict
-        num_posts = defaultdict(int)
         tag_posts = defaultdict(list)
         for data in self.post_list:
-            num_posts[data['user']['id']] += 1
             for tag in data['tags']:
                 tag_posts[tag['name']].append(data)
 
@@ -119,8 +270,8 @@ class PixivRepo:
 
         readme.append('<h2>Authors</h2>')
         readme.append('<ul>')
-        for author_id, info in authors.items():
-            readme.append(f'<li><a href="./{author_id}/README.md">{info["name"]}</a> ({num_posts[author_id]} posts)</li>')
+        for author_id, entry in authors.items():
+            readme.append(f'<li><a href="./{author_id}/README.md">{entry["info"]["name"]}</a> ({len(entry["posts"])} posts)</li>')
         readme.append('</ul>')
         return '\n'.join(readme)
         readme.append('<h2>Tags</h2>')
@@ -134,12 +285,17 @@ class PixivRepo:
             readme.append('</ul>')
         return '\n'.join(readme)
 
-    def remove_orphan(self):
+    def remove_orphan(self, full=True):
         import os
         import re
         prog = re.compile('^(\d+)_p\d+.jxl$')
-        for root, dirs, files in os.walk(self.base_path):
+        # Outside a full run, only directories of handled posts can have orphans
+        roots = [self.base_path] if full else [p for p in self.touched_dirs if p.exists()]
+        for root, dirs, files in (t for p in roots for t in os.walk(p)):
             for name in files:
+                if name.endswith(('.part', '.tmp')):
+                    (Path(root) / name).unlink()
+                    continue
                 result = prog.match(name)
                 if result:
                     pid = result.group(1)
@@ -147,34 +303,57 @@ class PixivRepo:
                     if not json_file.exists():
                         (Path(root) / name).unlink()
 
-    def post_process(self):
-        self.remove_all_files_with_suffix('.json')
-        self.remove_all_files_with_suffix('.md')
+    def load_post(self, author_id, post_id):
+        import json
+        with open(self.base_path / author_id / f'{post_id}.json', 'r') as f:
+            return json.load(f)
+
+    def post_process(self, full=True):
+        import json
+        if full:
+            self.state['authors'] = dict()
+        # Only files whose content differs are rewritten, and stale ones are
+        # removed afterwards, so the metadata is never missing mid-run
+        keep = set()
+        written = 0
+        def write(path, content):
+            nonlocal written
+            keep.add(path)
+            written += write_if_changed(path, content)
         for data in self.post_list:
             data.pop('total_view', None)
             data.pop('total_bookmarks', None)
-            with open(self.get_json_save_path(data), 'w') as f:
-                import json
-                json.dump(data, f, indent=2)
+            write(self.get_json_save_path(data), json.dumps(data, indent=2))
 
-        from collections import defaultdict
-        author_info = dict()
-        author_posts = defaultdict(list)
+        # Posts handled in this run are the newest bookmarks, so they go
+        # before whatever was recorded for their authors last time
+        authors = dict()
         for data in self.post_list:
-            author_id = data['user']['id']
-            if author_id in author_info:
-                assert author_info[author_id] == data['user']
+            author_id = str(data['user']['id'])
+            if author_id in authors:
+                assert authors[author_id]['info'] == data['user']
             else:
-                author_info[author_id] = data['user']
-            author_posts[author_id].append(data)
-        for author_id, info in author_info.items():
-            with open(self.base_path / str(author_id) / 'README.md', 'w') as f:
-                f.write(self.gen_author_readme(info, author_posts[author_id]))
+                authors[author_id] = {'info': data['user'], 'posts': []}
+            authors[author_id]['posts'].append(data['id'])
+        for author_id, entry in self.state['authors'].items():
+            if author_id in authors:
+                seen = set(authors[author_id]['posts'])
+                authors[author_id]['posts'] += (post_id for post_id in entry['posts'] if post_id not in seen)
+            else:
+                authors[author_id] = entry
+        self.state['authors'] = authors
+
+        handled = {data['id']: data for data in self.post_list}
+        for author_id in {str(data['user']['id']) for data in self.post_list}:
+            entry = authors[author_id]
+            posts = [handled[post_id] if post_id in handled else self.load_post(author_id, post_id) for post_id in entry['posts']]
+            write(self.base_path / author_id / 'README.md', self.gen_author_readme(entry['info'], posts))
 
-        with open(self.base_path / 'README.md', 'w') as f:
-            f.write(self.gen_overall_readme(author_info))
+        write(self.base_path / 'README.md', self.gen_overall_readme(authors))
+        removed = self.remove_stale(keep) if full else 0
+        print(f'Wrote {written} and removed {removed} metadata file(s)')
 
-def get_all_bookmark(api: AppPixivAPI, *args, **kwargs):
+def get_all_bookmark(api: AppPixivAPI, *args, since=None, cursor=None, **kwargs):
     max_bookmark_id = None
     while True:
         result = api.user_bookmarks_illust(*args, **kwargs, max_bookmark_id=max_bookmark_id)
@@ -189,6 +368,11 @@ def get_all_bookmark(api: AppPixivAPI, *args, **kwargs):
             k, v = t.split('=')
             if k == 'max_bookmark_id':
                 max_bookmark_id = v
+        if cursor is not None and 'newest' not in cursor:
+            cursor['newest'] = int(max_bookmark_id)
+        # Bookmarks from here on were all seen by the last run
+        if since is not None and int(max_bookmark_id) <= since:
+            break
 
 def main():
     from argparse import ArgumentParser
@@ -203,25 +387,59 @@ def main():
         required=False,
         default=len(os.sched_getaffinity(0)),
     )
+    parser.add_argument(
+        '--max-pending',
+        type=int,
+        default=256,
+        help='MB of downloaded images waiting for conversion before downloads pause',
+    )
+    parser.add_argument(
+        '-d', '--download-threads',
+        type=int,
+        default=8,
+        help='Number of images to download at once',
+    )
+    parser.add_argument(
+        '-f', '--full',
+        action='store_true',
+        help='Walk all bookmarks and rebuild every post JSON and README',
+    )
+    parser.add_argument(
+        '--full-every',
+        type=float,
+        default=7,
+        help='Days after which a run is automatically a full one',
+    )
     args = parser.parse_args()
     api = AppPixivAPI()
     api.auth(refresh_token=args.token)
-    repo = PixivRepo(args.output, api)
-    from tqdm import tqdm
-    for img in tqdm(get_all_bookmark(api, args.uid), desc='DL'):
-        repo.handle_post(img)
-    repo.post_process()
-    from concurrent.futures import ThreadPoolExecutor
+    from requests.adapters import HTTPAdapter
+    # Keep one connection per download thread alive to the image host
+    api.requests.mount('https://i.pximg.net/', HTTPAdapter(pool_maxsize=args.download_threads))
     num_threads = args.threads
     print(f'Running with {num_threads} threads')
-    with ThreadPoolExecutor(num_threads) as exe:
-        for _, img_path in tqdm(
-            zip(exe.map(to_jxl, repo.convert_list), repo.convert_list),
-            desc='JXL',
-            total=len(repo.convert_list),
-        ):
-            img_path.unlink()
-    repo.remove_orphan()
+    converter = JxlConverter(num_threads, args.max_pending << 20)
+    repo = PixivRepo(args.output, api, converter, args.download_threads)
+    full = args.full or repo.need_full(args.full_every * 86400)
+    since = None if full else repo.state['cursor']
+    print(f'Running a {"full" if full else "incremental"} sync')
+    cursor = dict()
+    from tqdm import tqdm
+    try:
+        for img in tqdm(get_all_bookmark(api, args.uid, since=since, cursor=cursor), desc='DL', position=0):
+            repo.handle_post(img)
+    finally:
+        failed = repo.wait_downloads()
+    repo.post_process(full)
+    repo.remove_orphan(full)
+    # Failed posts may be older than the cursor, so the next run walks everything
+    repo.state['cursor'] = None if failed else cursor.get('newest')
+    if full and not failed:
+        import time
+        repo.state['last_full'] = time.time()
+    repo.save_state()
+    if failed:
+        raise RuntimeError(f'{failed} post(s) failed to download')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,130 @@
+import json
+import time
+from pathlib import Path
+
+import requests
+from bs4 import BeautifulSoup
+from tqdm import tqdm
+import download
+from http_cache import HttpCache, write_atomic
+
+# The fixture store is an HttpCache directory plus a list of recorded novels
+
+class FixtureSession:
+    def __init__(self, store: HttpCache):
+        self.store = store
+
+    def get(self, url, headers=None, **kwargs):
+        if self.store.load(url) is None:
+            raise KeyError(f'{url} is not in the fixture store')
+        with open(self.store.get_paths(url)[1], 'r') as f:
+            body = f.read()
+        res = requests.Response()
+        res.url = url
+        res.status_code = 200
+        res.encoding = 'utf-8'
+        res._content = body.encode('utf-8')
+        return res
+
+def novel_class(url):
+    return download.only([c for c in download.novel_types if c.match(url)])
+
+def chapters(novel, limit=None):
+    ret = [v for v in novel.get_toc() if not v.get('no_store')]
+    return ret if limit is None else ret[:limit]
+
+def record(store_dir: Path, urls, limit):
+    download.http_cache.cache_dir = store_dir
+    list_path = store_dir / 'novels.json'
+    recorded = json.loads(list_path.read_text()) if list_path.exists() else []
+    for url in urls:
+        novel = novel_class(url)(url)
+        for v in tqdm(chapters(novel, limit), desc=url):
+            novel.req(v['url'])
+        if url not in recorded:
+            recorded.append(url)
+    store_dir.mkdir(exist_ok=True, parents=True)
+    write_atomic(list_path, json.dumps(recorded, indent=2))
+
+class Stage:
+    def __init__(self):
+        self.pages = 0
+        self.time = 0
+        self.peak = 0
+
+def measure(stage, func, trace):
+    import tracemalloc
+    if trace:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    ret = func()
+    if trace:
+        stage.peak = max(stage.peak, tracemalloc.get_traced_memory()[1] - base)
+    else:
+        stage.time += time.perf_counter() - start
+        stage.pages += 1
+    return ret
+
+def replay_novel(store, url, stats, trace):
+    NovelClass = novel_class(url)
+    novel = measure(stats['index'], lambda: NovelClass(url), trace)
+    measure(stats['readme'], novel.gen_readme, trace)
+    for v in chapters(novel):
+        # Record only keeps the first chapters of each novel
+        if store.load(v['url']) is None:
+            continue
+        measure(stats['content'], lambda: novel.gen_content(v), trace)
+
+def replay(store_dir: Path, urls, repeat):
+    import tracemalloc
+    store = HttpCache(store_dir)
+    download.session = FixtureSession(store)
+    download.http_cache = HttpCache()
+    download.limiter.interval = 0
+    if not urls:
+        urls = json.loads((store_dir / 'novels.json').read_text())
+    for url in urls:
+        stats = {name: Stage() for name in ['index', 'readme', 'content']}
+        for _ in range(repeat):
+            replay_novel(store, url, stats, False)
+        # Allocation tracing slows everything down, so it gets a pass of its own
+        tracemalloc.start()
+        try:
+            replay_novel(store, url, stats, True)
+        finally:
+            tracemalloc.stop()
+        print(url)
+        print(f'  {"stage":8} {"pages":>6} {"ms/page":>9} {"pages/s":>9} {"peak KiB":>9}')
+        for name, stage in stats.items():
+            if stage.pages == 0:
+                continue
+            print(f'  {name:8} {stage.pages // repeat:6} {stage.time / stage.pages * 1000:9.2f} {stage.pages / stage.time:9.1f} {stage.peak / 1024:9.0f}')
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Record novel pages and benchmark parsing them offline')
+    parser.add_argument('store', type=Path, help='Fixture store directory')
+    sub = parser.add_subparsers(dest='command', required=True)
+    record_parser = sub.add_parser('record', help='Download index and chapter pages into the store')
+    record_parser.add_argument('urls', nargs='+')
+    record_parser.add_argument('-l', '--limit', type=int, default=20, help='Chapters to record per novel')
+    record_parser.add_argument('-i', '--interval', type=float, default=download.limiter.interval, help='Minimum seconds between requests to one host')
+    replay_parser = sub.add_parser('replay', help='Time index, README and chapter generation from the store')
+    replay_parser.add_argument('urls', nargs='*', help='Novels to replay, all recorded ones by default')
+    replay_parser.add_argument('-n', '--repeat', type=int, default=3)
+    replay_parser.add_argument('--parser', choices=['lxml', 'html.parser'], default=download.page_parser, help='BeautifulSoup backend for downloaded pages')
+    replay_parser.add_argument('--no-index', action='store_true', help='Search the bare soup instead of a PageIndex, as before pages were indexed')
+    args = parser.parse_args()
+    if args.command == 'record':
+        download.limiter.interval = args.interval
+        record(args.store, args.urls, args.limit)
+    else:
+        download.page_parser = args.parser
+        if args.no_index:
+            download.parse_page = lambda text: BeautifulSoup(text, download.page_parser)
+        print(f'{args.parser}{" without" if args.no_index else " with"} page index')
+        replay(args.store, args.urls, args.repeat)
+
+if __name__ == '__main__':
+    main()
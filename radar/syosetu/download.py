@@ -1,4 +1,6 @@
 import re
+import threading
+import time
 from copy import copy
 from abc import ABCMeta, abstractmethod
 from pathlib import Path
@@ -7,7 +9,8 @@ from fake_useragent import UserAgent
 from bs4 import BeautifulSoup
 import requests
 from tqdm import tqdm
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse
+from http_cache import HttpCache, conditional_get, write_atomic
 
 ua = UserAgent()
 headers = {
@@ -18,6 +21,52 @@ proxies = {
    #'https': 'http://192.168.208.1:7890',
 }
 
+class HostLimiter:
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_time = dict()
+
+    def wait(self, url):
+        host = urlparse(url).hostname
+        with self.lock:
+            now = time.monotonic()
+            t = max(now, self.next_time.get(host, now))
+            self.next_time[host] = t + self.interval
+        time.sleep(t - now)
+
+limiter = HostLimiter(0.5)
+
+def site_of(url):
+    # ncode. and novel18.syosetu.com share one site budget
+    return '.'.join(urlparse(url).hostname.split('.')[-2:])
+
+class SiteSlots:
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.slots = dict()
+
+    def get(self, url):
+        site = site_of(url)
+        with self.lock:
+            if site not in self.slots:
+                self.slots[site] = threading.BoundedSemaphore(self.size)
+            return self.slots[site]
+
+site_slots = SiteSlots(4)
+
+def create_session():
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=32)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+session = create_session()
+http_cache = HttpCache()
+
 def only(arr):
     el = None
     for a in arr:
@@ -38,10 +87,26 @@ def unwrap_text(soup):
 def unwrap_innertext(soup):
     return unwrap_text(only(soup.contents))
 
-def write_text(path: Path, text):
+def text_digest(text):
+    import hashlib
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def file_digest(path: Path):
+    import hashlib
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+def write_text(path: Path, text, digest=None):
+    if digest is None:
+        digest = text_digest(text)
+    if file_digest(path) == digest:
+        return False
     path.parent.mkdir(exist_ok=True, parents=True)
-    with open(path, 'w') as f:
-        f.write(text)
+    write_atomic(path, text)
+    return True
 
 def migrate_children(a, b):
     for el in a.children:
@@ -54,18 +119,100 @@ def get_child(soup):
 def find_uniq(soup, *args, **kwargs):
     return only(soup.find_all(*args, **kwargs))
 
-def write_html(path, src):
+def detect_parser():
+    try:
+        import lxml
+        return 'lxml'
+    except ImportError:
+        return 'html.parser'
+
+# Only used for whole downloaded pages; fragments that are written back out
+# keep html.parser so that no <html><body> wrapper is added
+page_parser = detect_parser()
+
+class PageIndex:
+    def __init__(self, soup):
+        from bs4 import Tag
+        self.soup = soup
+        self.ids = dict()
+        self.classes = dict()
+        for el in soup.descendants:
+            if not isinstance(el, Tag):
+                continue
+            el_id = el.attrs.get('id')
+            if el_id is not None:
+                self.ids.setdefault(el_id, []).append(el)
+            for c in el.attrs.get('class', ()):
+                self.classes.setdefault(c, []).append(el)
+
+    def find_all(self, name=None, id=None, class_=None):
+        if id is not None:
+            found = self.ids.get(id, [])
+        elif class_ is not None:
+            found = self.classes.get(class_, [])
+        else:
+            return self.soup.find_all(name)
+        return [
+            el for el in found
+            if (name is None or el.name == name) and (class_ is None or class_ in el.attrs.get('class', ()))
+        ]
+
+def parse_page(text):
+    return PageIndex(BeautifulSoup(text, page_parser))
+
+def write_html(path, src, digest=None):
+    src = str(src)
+    src_digest = text_digest(src)
+    # Tidy output only depends on its input, so when the generated source
+    # matches the recorded digest and the file is untouched there is nothing to do
+    if digest is not None and digest[0] == src_digest and file_digest(path) == digest[1]:
+        return digest
     from tidylib import tidy_fragment
-    document, errors = tidy_fragment(str(src))
+    document, errors = tidy_fragment(src)
     assert not errors
-    write_text(path, document)
+    doc_digest = text_digest(document)
+    write_text(path, document, doc_digest)
+    return [src_digest, doc_digest]
 
 class BaseNovel(metaclass=ABCMeta):
+    req_kwargs = {}
+    # TOC fields whose change means the chapter page itself changed
+    change_keys = ('name', 'updated_on')
+
+    @classmethod
+    def req(cls, url):
+        with site_slots.get(url):
+            limiter.wait(url)
+            return http_cache.get(session, url, **cls.req_kwargs)
+
+    @classmethod
+    def req_chapter(cls, url, validators=None):
+        # Chapter validators are kept in toc.json next to the digest of the
+        # file they describe, so they are never ahead of the written chapter
+        with site_slots.get(url):
+            limiter.wait(url)
+            return conditional_get(session, url, validators, **cls.req_kwargs)
+
     @classmethod
     @abstractmethod
     def match(url):
         pass
 
+    def __init__(self, url) -> None:
+        self.url = url
+        res = self.req(url)
+        # An unchanged index page reuses what was parsed from it last time
+        state = http_cache.load_state(url) if res.not_modified else None
+        if state is not None and state['type'] == type(self).__name__:
+            self.__dict__.update(state['attrs'])
+        else:
+            self.parse_index(parse_page(res.text))
+            http_cache.save_state(url, {'type': type(self).__name__, 'attrs': vars(self)})
+
+    @abstractmethod
+    def parse_index(self, page):
+        pass
+
     @abstractmethod
     def get_save_path(self):
         pass
@@ -74,6 +221,9 @@ class BaseNovel(metaclass=ABCMeta):
     def get_toc(self):
         pass
 
+    def chapter_changed(self, old_item, new_item):
+        return any(old_item.get(k) != new_item.get(k) for k in self.change_keys)
+
     def gen_title_markdown(self):
         return f'【{self.author}】[{self.title}]({self.get_save_path()}/README.md)'
 
@@ -82,25 +232,26 @@ class BaseNovel(metaclass=ABCMeta):
         pass
 
     @abstractmethod
-    def gen_content(self, toc_item):
+    def gen_content(self, toc_item, validators=None):
         pass
 
 class SyosetuNovel(BaseNovel):
-    @staticmethod
-    def req(url):
-        return requests.get(url, headers=headers, proxies=proxies, cookies={'over18': 'yes'})
+    req_kwargs = {
+        'headers': headers,
+        'proxies': proxies,
+        'cookies': {'over18': 'yes'},
+    }
+    change_keys = ('name', 'created_on', 'updated_on')
 
     url_prog = re.compile(r'^https://(?:\w*).syosetu.com/(\w*)/?$')
     @classmethod
     def match(cls, url):
         return cls.url_prog.match(url)
 
-    def __init__(self, url) -> None:
+    def parse_index(self, page):
+        url = self.url
         url_match = self.match(url)
         self.id = url_match.group(1)
-        self.url = url
-        page = self.req(url).text
-        page = BeautifulSoup(page, 'html.parser')
         self.intro = find_uniq(page, id='novel_ex').decode_contents()
         self.title = unwrap_innertext(find_uniq(page, 'p', class_='novel_title'))
         writer_div = find_uniq(page, 'div', class_='novel_writername')
@@ -206,9 +357,11 @@ class SyosetuNovel(BaseNovel):
             soup.append(dl)
         return str(soup)
 
-    def gen_content(self, toc_item):
-        page = self.req(toc_item['url']).text
-        page = BeautifulSoup(page, 'html.parser')
+    def gen_content(self, toc_item, validators=None):
+        res = self.req_chapter(toc_item['url'], validators)
+        if res.not_modified:
+            return None, res.validators
+        page = parse_page(res.text)
         soup = BeautifulSoup()
 
         title = soup.new_tag('h1')
@@ -237,24 +390,18 @@ class SyosetuNovel(BaseNovel):
             soup.append(footer)
             migrate_children(novel_a, footer)
 
-        return str(soup)
+        return str(soup), res.validators
 
 class KakuyomuNovel(BaseNovel):
-    @staticmethod
-    def req(url):
-        return requests.get(url)
-
     url_prog = re.compile(r'^https://kakuyomu.jp/works/(\d*)$')
     @classmethod
     def match(cls, url):
         return cls.url_prog.match(url)
 
-    def __init__(self, url) -> None:
+    def parse_index(self, page):
+        url = self.url
         url_match = self.match(url)
         self.id = url_match.group(1)
-        self.url = url
-        page = self.req(url).text
-        page = BeautifulSoup(page, 'html.parser')
 
         title_href = get_child(find_uniq(page, id='workTitle'))
         assert title_href.attrs['href'] == f'/works/{self.id}'
@@ -292,12 +439,13 @@ class KakuyomuNovel(BaseNovel):
         self.catchpharse = unwrap_innertext(find_uniq(page, id='catchphrase-body'))
         assert self.author == unwrap_innertext(find_uniq(page, id='catchphrase-authorLabel'))
 
-        self.intro = copy(find_uniq(page, id='introduction'))
-        show_more = self.intro.find_all(class_='ui-truncateTextButton-restText')
+        intro = copy(find_uniq(page, id='introduction'))
+        show_more = intro.find_all(class_='ui-truncateTextButton-restText')
         if show_more:
             show_more = only(show_more).extract()
-            find_uniq(self.intro, class_='ui-truncateTextButton-expandButton').extract()
-            migrate_children(show_more, self.intro)
+            find_uniq(intro, class_='ui-truncateTextButton-expandButton').extract()
+            migrate_children(show_more, intro)
+        self.intro = intro.decode_contents()
 
         self.toc = []
         chapter_cnt = 0
@@ -385,7 +533,7 @@ class KakuyomuNovel(BaseNovel):
         soup.append(details := soup.new_tag('details'))
         details.append(summary := soup.new_tag('summary'))
         summary.string = '紹介'
-        migrate_children(self.intro, details)
+        migrate_children(BeautifulSoup(self.intro, 'html.parser'), details)
 
         dl = None
         for v in self.toc:
@@ -413,9 +561,11 @@ class KakuyomuNovel(BaseNovel):
 
         return str(soup)
 
-    def gen_content(self, toc_item):
-        page = self.req(toc_item['url']).text
-        page = BeautifulSoup(page, 'html.parser')
+    def gen_content(self, toc_item, validators=None):
+        res = self.req_chapter(toc_item['url'], validators)
+        if res.not_modified:
+            return None, res.validators
+        page = parse_page(res.text)
         soup = BeautifulSoup()
 
         soup.append(title := soup.new_tag('h1'))
@@ -425,56 +575,147 @@ class KakuyomuNovel(BaseNovel):
         content_el = find_uniq(page, 'div', class_='widget-episodeBody')
         migrate_children(content_el, soup)
 
-        return str(soup)
+        return str(soup), res.validators
 
 novel_types: List[BaseNovel] = [
     SyosetuNovel,
     KakuyomuNovel
 ]
 
+def sync_novel(repo_dir: Path, url, exe, progress):
+    import json
+    from concurrent.futures import as_completed
+    NovelClass = only([c for c in novel_types if c.match(url)])
+    novel = NovelClass(url)
+    novel_path = repo_dir / novel.get_save_path()
+    write_html(novel_path / 'README.md', novel.gen_readme())
+    toc_path = novel_path / 'toc.json'
+    if toc_path.exists():
+        with open(toc_path, 'r') as f:
+            old_toc = json.load(f)
+    else:
+        old_toc = []
+    old_toc_map = {v['id']: v for v in old_toc if isinstance(v, dict) and not v.get('no_store')}
+    new_toc = novel.get_toc()
+    new_toc_map = {v['id']: v for v in new_toc if not v.get('no_store')}
+    for v in old_toc:
+        if not isinstance(v, dict) or v.get('no_store'):
+            continue
+        if v['id'] not in new_toc_map:
+            (novel_path / v['path']).unlink(missing_ok=True)
+    def move_chapter(v, t):
+        old_path = novel_path / t['path']
+        if old_path != novel_path / v['path']:
+            (novel_path / v['path']).parent.mkdir(exist_ok=True, parents=True)
+            old_path.replace(novel_path / v['path'])
+    def fetch_chapter(v, t):
+        old_path = None if t is None else novel_path / t['path']
+        # Revalidating only helps when the old file is still there to keep
+        validators = t.get('validators') if old_path is not None and old_path.exists() else None
+        content, validators = novel.gen_content(v, validators)
+        if content is None:
+            move_chapter(v, t)
+            return t.get('digest'), validators
+        digest = write_html(novel_path / v['path'], content, None if t is None else t.get('digest'))
+        if old_path is not None and old_path != novel_path / v['path']:
+            old_path.unlink(missing_ok=True)
+        return digest, validators
+    failed = set()
+    futures = dict()
+    for v in new_toc:
+        if v.get('no_store'):
+            continue
+        t = old_toc_map.get(v['id'])
+        if t is not None and not novel.chapter_changed(t, v) and (novel_path / t['path']).exists():
+            # Display-only fields such as Kakuyomu's updated_str may drift
+            # without the chapter page changing, so they do not trigger a fetch
+            move_chapter(v, t)
+            for k in ('digest', 'validators'):
+                if k in t:
+                    v[k] = t[k]
+            continue
+        futures[exe.submit(fetch_chapter, v, t)] = v
+    with progress.get_lock():
+        progress.total += len(futures)
+        progress.refresh()
+    for future in as_completed(futures):
+        progress.update()
+        v = futures[future]
+        try:
+            digest, validators = future.result()
+        except Exception as e:
+            failed.add(v['id'])
+            tqdm.write(f'Failed to download {v["url"]}: {e!r}')
+            continue
+        if digest is not None:
+            v['digest'] = digest
+        if validators:
+            v['validators'] = validators
+    # Failed chapters keep their old entry so that the next run retries them
+    saved_toc = []
+    for v in new_toc:
+        if not v.get('no_store') and v['id'] in failed:
+            v = old_toc_map.get(v['id'])
+            if v is None:
+                continue
+        saved_toc.append(v)
+    write_text(toc_path, json.dumps(saved_toc, indent=2))
+    return novel, len(failed)
+
 def main():
+    global page_parser
     from argparse import ArgumentParser
     parser = ArgumentParser()
     parser.add_argument('repo_dir', nargs=1, type=Path)
+    parser.add_argument('-j', '--threads', type=int, default=8, help='Number of chapters to download at once across all novels')
+    parser.add_argument('-n', '--novels', type=int, default=4, help='Number of novels to sync at once')
+    parser.add_argument('-s', '--site-threads', type=int, default=site_slots.size, help='Maximum concurrent requests to one site')
+    parser.add_argument('-i', '--interval', type=float, default=limiter.interval, help='Minimum seconds between requests to one host')
+    parser.add_argument('-c', '--cache', type=Path, default=Path.home() / '.cache' / 'radar-syosetu', help='HTTP cache directory')
+    parser.add_argument('--no-cache', action='store_true', help='Do not use the HTTP cache')
+    parser.add_argument('--parser', choices=['lxml', 'html.parser'], default=page_parser, help='BeautifulSoup backend for downloaded pages')
     args = parser.parse_args()
+    page_parser = args.parser
+    limiter.interval = args.interval
+    site_slots.size = args.site_threads
+    if not args.no_cache:
+        http_cache.cache_dir = args.cache
     repo_dir = args.repo_dir[0]
     print(f'Repo: {repo_dir}')
     with open(repo_dir / 'source.md', 'r') as f:
         readme = BeautifulSoup(f, 'html.parser')
-    for anchor in tqdm(readme.find_all('a', class_='download')):
-        url = unwrap_innertext(anchor)
-        NovelClass = only([c for c in novel_types if c.match(url)])
-        novel = NovelClass(url)
-        anchor.replace_with(novel.gen_title_markdown())
-        novel_path = repo_dir / novel.get_save_path()
-        write_html(novel_path / 'README.md', novel.gen_readme())
-        toc_path = novel_path / 'toc.json'
-        if toc_path.exists():
-            with open(toc_path, 'r') as f:
-                import json
-                old_toc = json.load(f)
-        else:
-            old_toc = []
-        old_toc_map = {v['id']: v for v in old_toc if isinstance(v, dict) and not v.get('no_store')}
-        new_toc = novel.get_toc()
-        new_toc_map = {v['id']: v for v in new_toc if not v.get('no_store')}
-        for v in old_toc:
-            if not isinstance(v, dict) or v.get('no_store'):
-                continue
-            if v['id'] not in new_toc_map:
-                (novel_path / v['path']).unlink(missing_ok=True)
-        for v in tqdm(new_toc, desc=novel.get_save_path()):
-            if v.get('no_store'):
+    anchors = readme.find_all('a', class_='download')
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    results = dict()
+    failed = []
+    # Chapters of every novel share one pool, so -j bounds the total work
+    with ThreadPoolExecutor(args.threads) as exe, ThreadPoolExecutor(args.novels) as novel_exe, tqdm(total=0, unit='ch') as progress:
+        futures = dict()
+        for anchor in anchors:
+            url = unwrap_innertext(anchor)
+            futures[novel_exe.submit(sync_novel, repo_dir, url, exe, progress)] = anchor
+        progress.set_description(f'0/{len(futures)} novels')
+        for cnt, future in enumerate(as_completed(futures), 1):
+            progress.set_description(f'{cnt}/{len(futures)} novels')
+            anchor = futures[future]
+            url = unwrap_innertext(anchor)
+            try:
+                novel, failed_chapters = future.result()
+            except Exception as e:
+                failed.append(url)
+                tqdm.write(f'Failed to sync {url}: {e!r}')
                 continue
-            t = old_toc_map.get(v['id'])
-            if t is None or t != v:
-                if t is not None:
-                    (novel_path / t['path']).unlink(missing_ok=True)
-                write_html(novel_path / v['path'], novel.gen_content(v))
-        with open(toc_path, 'w') as f:
-            import json
-            json.dump(new_toc, f, indent=2)
+            results[id(anchor)] = novel
+            if failed_chapters:
+                failed.append(url)
+                tqdm.write(f'{failed_chapters} chapter(s) of {url} failed')
+    # Novels that could not be synced keep their download link
+    for anchor in anchors:
+        if id(anchor) in results:
+            anchor.replace_with(results[id(anchor)].gen_title_markdown())
     write_text(repo_dir / 'README.md', str(readme))
+    if failed:
+        raise RuntimeError(f'{len(failed)} novel(s) failed: {", ".join(failed)}')
 
 if __name__ == '__main__':
     main()
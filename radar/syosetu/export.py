@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+from html import escape
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+formats = {'epub': '.epub', 'html': '.html.gz'}
+
+def novel_key(novel_path: Path):
+    return f'{novel_path.parent.name}-{novel_path.name}'
+
+def list_novels(repo_dir: Path):
+    return sorted(p.parent for p in repo_dir.glob('*/*/toc.json'))
+
+def load_toc(novel_path: Path):
+    with open(novel_path / 'toc.json', 'r') as f:
+        return json.load(f)
+
+def file_digest(path: Path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def novel_fingerprint(novel_path: Path, toc, fmt):
+    h = hashlib.sha1(fmt.encode('utf-8'))
+    h.update(file_digest(novel_path / 'README.md').encode('ascii'))
+    for v in toc:
+        # HTTP validators can change while the chapter text stays the same
+        h.update(json.dumps({k: x for k, x in v.items() if k != 'validators'}, sort_keys=True).encode('utf-8'))
+        # Chapters written before toc.json carried digests are hashed directly
+        if not v.get('no_store') and 'digest' not in v and (novel_path / v['path']).exists():
+            h.update(file_digest(novel_path / v['path']).encode('ascii'))
+    return h.hexdigest()
+
+def iter_chapters(novel_path: Path, toc):
+    heading = None
+    for v in toc:
+        if v.get('no_store'):
+            heading = v['name']
+            continue
+        path = novel_path / v['path']
+        if not path.exists():
+            print(f'Missing chapter {path}, skipped')
+            continue
+        with open(path, 'r') as f:
+            yield heading, v, f.read()
+        heading = None
+
+def read_readme(novel_path: Path, toc, href):
+    with open(novel_path / 'README.md', 'r') as f:
+        soup = BeautifulSoup(f, 'html.parser')
+    title = soup.find('h1').get_text().strip()
+    author = soup.find('a')
+    author = '' if author is None else author.get_text().strip()
+    # Chapter links point at the .md files, which are not part of the export
+    paths = {v['path']: v for v in toc if not v.get('no_store')}
+    for a in soup.find_all('a', href=True):
+        if a.attrs['href'] in paths:
+            a.attrs['href'] = href(paths[a.attrs['href']])
+    return soup.decode(formatter='minimal'), title, author
+
+def gen_nav(toc, href):
+    ret = []
+    heading = None
+    group = False
+    for v in toc:
+        if v.get('no_store'):
+            if group:
+                ret.append('</ol></li>')
+            # Opened at its first chapter, since a nav ol must not be empty
+            heading = v
+            group = False
+        else:
+            if heading is not None:
+                ret.append(f'<li><span>{escape(heading["name"])}</span><ol>')
+                heading = None
+                group = True
+            ret.append(f'<li><a href="{href(v)}">{escape(v["name"])}</a></li>')
+    if group:
+        ret.append('</ol></li>')
+    return '<ol>' + ''.join(ret) + '</ol>'
+
+def export_html(novel_path: Path, toc, out_path: Path):
+    import gzip
+    href = lambda v: '#c' + v['id']
+    readme, title, author = read_readme(novel_path, toc, href)
+    with gzip.open(out_path, 'wt', encoding='utf-8') as f:
+        f.write(f'<!DOCTYPE html>\n<html lang="ja"><head><meta charset="utf-8"><title>{escape(title)}</title></head><body>\n')
+        f.write(readme)
+        f.write(f'\n<nav>{gen_nav(toc, href)}</nav>\n')
+        for heading, v, text in iter_chapters(novel_path, toc):
+            if heading is not None:
+                f.write(f'<h2>{escape(heading)}</h2>\n')
+            f.write(f'<section id="c{v["id"]}">\n{text}\n</section>\n')
+        f.write('</body></html>\n')
+
+def xhtml_page(title, body):
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="ja">'
+        f'<head><title>{escape(title)}</title></head><body>\n{body}\n</body></html>\n'
+    )
+
+def to_xhtml(text):
+    # Tidy emits HTML; bs4 re-serialises it with closed void tags and escaped text
+    return BeautifulSoup(text, 'html.parser').decode(formatter='minimal')
+
+container_xml = '''<?xml version="1.0" encoding="utf-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>
+'''
+
+def export_epub(novel_path: Path, toc, out_path: Path):
+    import time
+    import zipfile
+    chapter_href = lambda v: f'c{v["id"]}.xhtml'
+    readme, title, author = read_readme(novel_path, toc, chapter_href)
+    items = [('intro', 'intro.xhtml')]
+    with zipfile.ZipFile(out_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        # The mimetype entry has to come first and be stored uncompressed
+        zf.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        zf.writestr('META-INF/container.xml', container_xml)
+        zf.writestr('OEBPS/intro.xhtml', xhtml_page(title, readme))
+        written = set()
+        for heading, v, text in iter_chapters(novel_path, toc):
+            body = to_xhtml(text)
+            if heading is not None:
+                body = f'<h2>{escape(heading)}</h2>\n{body}'
+            zf.writestr(f'OEBPS/{chapter_href(v)}', xhtml_page(v['name'], body))
+            items.append((f'c{v["id"]}', chapter_href(v)))
+            written.add(v['id'])
+        nav_toc = [v for v in toc if v.get('no_store') or v['id'] in written]
+        zf.writestr('OEBPS/nav.xhtml', xhtml_page(title, f'<nav epub:type="toc">{gen_nav(nav_toc, chapter_href)}</nav>'))
+        manifest = ''.join(f'<item id="{i}" href="{href}" media-type="application/xhtml+xml"/>' for i, href in items)
+        spine = ''.join(f'<itemref idref="{i}"/>' for i, href in items)
+        modified = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        zf.writestr('OEBPS/content.opf', f'''<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="uid">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:identifier id="uid">urn:radar:{novel_key(novel_path)}</dc:identifier>
+<dc:title>{escape(title)}</dc:title>
+<dc:creator>{escape(author)}</dc:creator>
+<dc:language>ja</dc:language>
+<meta property="dcterms:modified">{modified}</meta>
+</metadata>
+<manifest><item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>{manifest}</manifest>
+<spine>{spine}</spine>
+</package>
+''')
+
+def export_novel(novel_path: Path, out_path: Path, fmt):
+    toc = load_toc(novel_path)
+    tmp_path = out_path.with_name(out_path.name + '.tmp')
+    if fmt == 'epub':
+        export_epub(novel_path, toc, tmp_path)
+    else:
+        export_html(novel_path, toc, tmp_path)
+    os.replace(tmp_path, out_path)
+
+def main():
+    from argparse import ArgumentParser
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from tqdm import tqdm
+    parser = ArgumentParser(description='Export downloaded novels as EPUB or single HTML files')
+    parser.add_argument('repo_dir', type=Path)
+    parser.add_argument('-o', '--output', type=Path, default=Path('export'), help='Output directory')
+    parser.add_argument('-f', '--format', choices=list(formats), default='epub')
+    parser.add_argument('-j', '--jobs', type=int, default=len(os.sched_getaffinity(0)), help='Number of novels to export at once')
+    parser.add_argument('--force', action='store_true', help='Export novels even if they did not change')
+    args = parser.parse_args()
+    args.output.mkdir(exist_ok=True, parents=True)
+    manifest_path = args.output / 'export.json'
+    manifest = dict()
+    if manifest_path.exists():
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    jobs = dict()
+    for novel_path in list_novels(args.repo_dir):
+        key = novel_key(novel_path)
+        out_path = args.output / (key + formats[args.format])
+        fingerprint = novel_fingerprint(novel_path, load_toc(novel_path), args.format)
+        if not args.force and manifest.get(out_path.name) == fingerprint and out_path.exists():
+            continue
+        jobs[out_path.name] = (novel_path, out_path, fingerprint)
+    failed = []
+    with ProcessPoolExecutor(args.jobs) as exe:
+        futures = {exe.submit(export_novel, novel_path, out_path, args.format): key for key, (novel_path, out_path, fingerprint) in jobs.items()}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            key = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                failed.append(key)
+                tqdm.write(f'Failed to export {key}: {e!r}')
+                continue
+            manifest[key] = jobs[key][2]
+    tmp_path = manifest_path.with_name(manifest_path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+    if failed:
+        raise RuntimeError(f'{len(failed)} novel(s) failed to export: {", ".join(failed)}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+class CachedResponse:
+    def __init__(self, url, text, not_modified, validators=None):
+        self.url = url
+        self.text = text
+        self.not_modified = not_modified
+        self.validators = validators or {}
+
+def conditional_get(session, url, validators=None, headers=None, **kwargs):
+    # A 304 carries no text, the caller keeps whatever the validators describe
+    headers = dict(headers or {})
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    res = session.get(url, headers=headers, **kwargs)
+    if res.status_code == 304 and validators:
+        return CachedResponse(url, None, True, validators)
+    res.raise_for_status()
+    validators = {'etag': res.headers.get('ETag'), 'last_modified': res.headers.get('Last-Modified')}
+    return CachedResponse(url, res.text, False, {k: v for k, v in validators.items() if v})
+
+def write_atomic(path: Path, text: str):
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+class HttpCache:
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+
+    def get_paths(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        base = Path(self.cache_dir) / key[:2] / key
+        return base.with_suffix('.json'), base.with_suffix('.html')
+
+    def load(self, url):
+        if self.cache_dir is None:
+            return None
+        meta_path, body_path = self.get_paths(url)
+        if not meta_path.exists() or not body_path.exists():
+            return None
+        with open(meta_path, 'r') as f:
+            return json.load(f)
+
+    def get(self, session, url, headers=None, **kwargs):
+        meta = self.load(url)
+        res = conditional_get(session, url, meta, headers, **kwargs)
+        if res.not_modified:
+            with open(self.get_paths(url)[1], 'r') as f:
+                res.text = f.read()
+            return res
+        if self.cache_dir is not None:
+            meta_path, body_path = self.get_paths(url)
+            meta_path.parent.mkdir(exist_ok=True, parents=True)
+            write_atomic(body_path, res.text)
+            write_atomic(meta_path, json.dumps({'url': url, **res.validators}))
+        return res
+
+    def load_state(self, url):
+        meta = self.load(url)
+        if meta is None:
+            return None
+        return meta.get('state')
+
+    def save_state(self, url, state):
+        meta = self.load(url)
+        if meta is None:
+            return
+        meta['state'] = state
+        write_atomic(self.get_paths(url)[0], json.dumps(meta, ensure_ascii=False))
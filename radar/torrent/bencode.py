@@ -1,89 +1,395 @@
-from typing import List
+from collections.abc import Mapping, Sequence
+from functools import lru_cache
+from typing import Callable
 
 class BTFailure(Exception):
     pass
 
+# Values stored under these keys are returned as memoryview slices of the
+# input instead of being copied and tried as utf-8.
+BINARY_KEYS = frozenset(['pieces'])
+
+def as_buffer(x) -> memoryview:
+    buf = memoryview(x)
+    if buf.format != 'B' or buf.ndim != 1:
+        buf = buf.cast('B')
+    return buf
+
+def as_bytes(x) -> bytes:
+    return x if type(x) is bytes else bytes(as_buffer(x))
+
 def decode_int(x, f):
     f += 1
     newf = x.index(b'e', f)
     n = int(x[f:newf])
     if x[f] == ord('-'):
         if x[f + 1] == ord('0'):
-            raise ValueError
-    elif x[f] == ord('0') and newf != f+1:
-        raise ValueError
-    return (n, newf+1)
+            raise ValueError(f'invalid integer at offset {f - 1}')
+    elif x[f] == ord('0') and newf != f + 1:
+        raise ValueError(f'invalid integer at offset {f - 1}')
+    return (n, newf + 1)
 
 def decode_string(x, f):
+    if not ord('0') <= x[f] <= ord('9'):
+        raise ValueError(f'invalid string length at offset {f}')
     colon = x.index(b':', f)
     n = int(x[f:colon])
-    if x[f] == ord('0') and colon != f+1:
-        raise ValueError
+    if x[f] == ord('0') and colon != f + 1:
+        raise ValueError(f'invalid string length at offset {f}')
     colon += 1
-    def try_decode(s):
+    if colon + n > len(x):
+        raise ValueError(f'string at offset {f} exceeds input')
+    return (x[colon:colon + n], colon + n)
+
+def try_decode(s):
+    try:
+        return str(s, 'utf-8')
+    except UnicodeDecodeError:
+        return bytes(s)
+
+def bdecode_span(x, span_key=None, binary_keys=BINARY_KEYS):
+    # Also returns the byte span of span_key in the root dict and whether
+    # all dict keys are sorted, both found in the same pass
+    if type(x) is not bytes:
+        x = bytes(x)
+    index = x.index
+    n = len(x)
+    mv = None
+    # Each entry is the enclosing (container, is_dict, key, last raw key)
+    stack = []
+    root = top = key = last = None
+    is_dict = False
+    canonical = True
+    start = span = None
+    f = 0
+    try:
+        while True:
+            c = x[f]
+            if c == 101 and top is not None:
+                v = top
+                f += 1
+                top, is_dict, key, last = stack.pop()
+                if is_dict:
+                    top[key] = v
+                    if top is root and key == span_key:
+                        span = (start, f)
+                elif top is None:
+                    break
+                else:
+                    top.append(v)
+                continue
+            if is_dict:
+                # Read the key inline, the value follows right after it
+                if not 48 <= c <= 57:
+                    raise ValueError(f'invalid dict key at offset {f}')
+                colon = index(b':', f)
+                k = x[f:colon]
+                if c == 48 and colon != f + 1:
+                    raise ValueError(f'invalid string length at offset {f}')
+                f = colon + 1 + int(k)
+                k = x[colon + 1:f]
+                if last is not None and k <= last:
+                    canonical = False
+                last = key = k
+                try:
+                    key = k.decode('utf-8')
+                except UnicodeDecodeError:
+                    pass
+                if top is root:
+                    start = f
+                c = x[f]
+            if 48 <= c <= 57:
+                colon = index(b':', f)
+                l = int(x[f:colon])
+                if c == 48 and colon != f + 1:
+                    raise ValueError(f'invalid string length at offset {f}')
+                f = colon + 1 + l
+                if f > n:
+                    raise ValueError(f'string at offset {colon} exceeds input')
+                if is_dict and key in binary_keys:
+                    if mv is None:
+                        mv = memoryview(x)
+                    v = mv[colon + 1:f]
+                else:
+                    v = x[colon + 1:f]
+                    try:
+                        v = v.decode('utf-8')
+                    except UnicodeDecodeError:
+                        pass
+            elif c == 105:
+                e = index(b'e', f + 1)
+                v = int(x[f + 1:e])
+                if x[f + 1] == 45:
+                    if x[f + 2] == 48:
+                        raise ValueError(f'invalid integer at offset {f}')
+                elif x[f + 1] == 48 and e != f + 2:
+                    raise ValueError(f'invalid integer at offset {f}')
+                f = e + 1
+            elif c == 108 or c == 100:
+                stack.append((top, is_dict, key, last))
+                top = {} if c == 100 else []
+                if root is None:
+                    root = top
+                is_dict = c == 100
+                last = None
+                f += 1
+                continue
+            else:
+                raise ValueError(f'invalid token {chr(c)!r} at offset {f}')
+            if is_dict:
+                top[key] = v
+                if top is root and key == span_key:
+                    span = (start, f)
+            elif top is None:
+                break
+            else:
+                top.append(v)
+    except IndexError:
+        raise ValueError('unexpected end of data') from None
+    if f != n:
+        raise ValueError('invalid bencoded value (data after valid prefix)')
+    return (v, span, canonical)
+
+def bdecode(x, binary_keys=BINARY_KEYS):
+    return bdecode_span(x, None, binary_keys)[0]
+
+def skip_value(x, f):
+    # Only lengths are parsed, values are checked when they are decoded
+    index = x.index
+    depth = 0
+    try:
+        while True:
+            c = x[f]
+            if c == 108 or c == 100:
+                depth += 1
+                f += 1
+                continue
+            elif c == 101:
+                if depth == 0:
+                    raise ValueError(f'unexpected end marker at offset {f}')
+                depth -= 1
+                f += 1
+            elif c == 105:
+                f = index(b'e', f + 1) + 1
+            elif 48 <= c <= 57:
+                colon = index(b':', f)
+                f = colon + 1 + int(x[f:colon])
+            else:
+                raise ValueError(f'invalid token {chr(c)!r} at offset {f}')
+            if depth == 0:
+                if f > len(x):
+                    raise ValueError('unexpected end of data')
+                return f
+    except IndexError:
+        raise ValueError('unexpected end of data') from None
+
+def decode_lazy(x, f, key=None, binary_keys=BINARY_KEYS, end=None):
+    if f >= len(x):
+        raise ValueError('unexpected end of data')
+    c = x[f]
+    if c == ord('l') or c == ord('d'):
+        v = (LazyList if c == ord('l') else LazyDict)(x, f, binary_keys)
+        v._end = end
+        return v
+    elif c == ord('i'):
+        return decode_int(x, f)[0]
+    v, end = decode_string(x, f)
+    if key in binary_keys:
+        return memoryview(x)[end - len(v):end]
+    return try_decode(v)
+
+class LazyValue:
+    def __init__(self, x, start, binary_keys):
+        self.buf = x
+        self.start = start
+        self.binary_keys = binary_keys
+        self._end = None
+        # Offset of the first child that has not been indexed yet
+        self._pos = start + 1
+        # (index, view) of a container child handed out before its end was
+        # known. It finds its own end when scanned, so it is walked only once.
+        self._pending = None
+
+    @property
+    def end(self):
+        if self._end is None:
+            self._scan()
+        return self._end
+
+    @property
+    def span(self):
+        return (self.start, self.end)
+
+    @property
+    def raw(self):
+        return self.buf[self.start:self.end]
+
+    def decode(self):
+        return bdecode(self.raw, self.binary_keys)
+
+    def _skip(self, i, f, wanted):
+        x = self.buf
+        if wanted and (x[f] == ord('l') or x[f] == ord('d')):
+            self._pending = (i, decode_lazy(x, f, None, self.binary_keys))
+            return None
+        self._pos = skip_value(x, f)
+        return self._pos
+
+    def _resolve(self):
+        i, v = self._pending
+        self._pending = None
+        self._pos = v.end
+        self._index[i] = (v.start, self._pos)
+
+    def _get(self, i, key=None):
+        f, end = self._index[i]
+        if end is None:
+            return self._pending[1]
+        return decode_lazy(self.buf, f, key, self.binary_keys, end)
+
+    def span_of(self, i):
+        f, end = self._locate(i)
+        if end is None:
+            self._resolve()
+            f, end = self._index[i]
+        return (f, end)
+
+class LazyDict(LazyValue, Mapping):
+    def __init__(self, x, start, binary_keys=BINARY_KEYS):
+        super().__init__(x, start, binary_keys)
+        self._index = dict()
+
+    def _scan(self, key=None):
+        x = self.buf
+        try:
+            while self._pos is not None:
+                if self._pending is not None:
+                    self._resolve()
+                if x[self._pos] == ord('e'):
+                    self._end = self._pos + 1
+                    self._pos = None
+                    break
+                k, f = decode_string(x, self._pos)
+                k = try_decode(k)
+                self._index[k] = (f, self._skip(k, f, k == key))
+                if k == key:
+                    break
+        except IndexError:
+            raise ValueError('unexpected end of data') from None
+
+    def _locate(self, key):
+        if key not in self._index:
+            self._scan(key)
+        return self._index[key]
+
+    def __getitem__(self, key):
+        self._locate(key)
+        return self._get(key, key)
+
+    def __contains__(self, key):
+        if key not in self._index:
+            self._scan(key)
+        return key in self._index
+
+    def __iter__(self):
+        self._scan()
+        return iter(self._index)
+
+    def __len__(self):
+        self._scan()
+        return len(self._index)
+
+class LazyList(LazyValue, Sequence):
+    def __init__(self, x, start, binary_keys=BINARY_KEYS):
+        super().__init__(x, start, binary_keys)
+        self._index = []
+
+    def _scan(self, i=None):
+        x = self.buf
         try:
-            return s.decode('utf-8')
-        except:
-            return s
-    return (try_decode(x[colon:colon+n]), colon+n)
-
-def decode_list(x, f):
-    r, f = [], f + 1
-    while x[f] != ord('e'):
-        v, f = decode_func[x[f]](x, f)
-        r.append(v)
-    return (r, f + 1)
-
-def decode_dict(x, f):
-    r, f = {}, f+1
-    while x[f] != ord('e'):
-        k, f = decode_string(x, f)
-        r[k], f = decode_func[x[f]](x, f)
-    return (r, f + 1)
-
-decode_func = dict()
-decode_func['l'] = decode_list
-decode_func['d'] = decode_dict
-decode_func['i'] = decode_int
-decode_func.update({str(i): decode_string for i in range(10)})
-decode_func = {ord(k): v for k, v in decode_func.items()}
-
-def bdecode(x: bytes):
-    if x[0] not in decode_func:
-        print(x)
-    r, l = decode_func[x[0]](x, 0)
-    assert l == len(x), "invalid bencoded value (data after valid prefix)"
-    return r
-
-def encode_int(x: int, r: List[bytes]):
-    r += b'i', str(x).encode('utf-8'), b'e'
-
-def encode_bool(x: bool, r: List[bytes]):
-    encode_int(int(x), r)
-
-def encode_string(x: str, r: List[bytes]):
-    encode_bytes(x.encode('utf-8'), r)
-
-def encode_list(x: list, r: List[bytes]):
-    r.append(b'l')
+            while self._pos is not None and (i is None or i >= len(self._index)):
+                if self._pending is not None:
+                    self._resolve()
+                f = self._pos
+                if x[f] == ord('e'):
+                    self._end = f + 1
+                    self._pos = None
+                    break
+                j = len(self._index)
+                self._index.append((f, self._skip(j, f, j == i)))
+        except IndexError:
+            raise ValueError('unexpected end of data') from None
+
+    def _locate(self, i):
+        self._scan(None if i < 0 else i)
+        return self._index[i]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        self._locate(i)
+        return self._get(i)
+
+    def __len__(self):
+        self._scan()
+        return len(self._index)
+
+def bdecode_lazy(x, binary_keys=BINARY_KEYS):
+    # Containers are only indexed as far as lookups require, so trailing
+    # data after the root value is not detected here.
+    return decode_lazy(as_bytes(x), 0, None, binary_keys)
+
+def find_span(x, path=()):
+    buf = as_bytes(x)
+    if not path:
+        return (0, skip_value(buf, 0))
+    v = decode_lazy(buf, 0)
+    for k in path[:-1]:
+        if not isinstance(v, LazyValue):
+            raise KeyError(k)
+        v = v[k]
+    if not isinstance(v, LazyValue):
+        raise KeyError(path[-1])
+    return v.span_of(path[-1])
+
+def is_canonical(x):
+    try:
+        return bdecode_span(x)[2]
+    except ValueError:
+        return False
+
+def encode_int(x: int, w: Callable):
+    w(b'i%de' % x)
+
+def encode_bool(x: bool, w: Callable):
+    encode_int(int(x), w)
+
+def encode_string(x: str, w: Callable):
+    encode_bytes(x.encode('utf-8'), w)
+
+def encode_list(x: list, w: Callable):
+    w(b'l')
     for i in x:
-        encode_any(i, r)
-    r.append(b'e')
+        encode_any(i, w)
+    w(b'e')
+
+@lru_cache(maxsize=1024)
+def sorted_keys(keys: tuple):
+    return sorted(keys)
 
-def encode_dict(x: dict, r: List[bytes]):
-    r.append(b'd')
-    ilist = list(x.items())
-    ilist.sort()
-    for k, v in ilist:
-        encode_string(k, r)
-        encode_any(v, r)
-    r.append(b'e')
+def encode_dict(x: dict, w: Callable):
+    w(b'd')
+    for k in sorted_keys(tuple(x)):
+        encode_string(k, w)
+        encode_any(x[k], w)
+    w(b'e')
 
-def encode_bytes(x: bytes, r: List[bytes]):
-    r += str(len(x)).encode('utf-8'), b':', x
+def encode_bytes(x: bytes, w: Callable):
+    w(b'%d:' % len(x))
+    w(x)
 
-def encode_any(x, r: List[bytes]):
-    encode_func[type(x)](x, r)
+def encode_any(x, w: Callable):
+    encode_func[type(x)](x, w)
 
 encode_func = {
     int: encode_int,
@@ -93,9 +399,15 @@ encode_func = {
     dict: encode_dict,
     bool: encode_bool,
     bytes: encode_bytes,
+    memoryview: encode_bytes,
 }
 
+def encode_to(x, f):
+    encode_any(x, f.write)
+
+def bencode_into(x, buf: bytearray):
+    encode_any(x, buf.extend)
+    return buf
+
 def bencode(x):
-    r = []
-    encode_any(x, r)
-    return b''.join(r)
+    return bytes(bencode_into(x, bytearray()))
@@ -0,0 +1,91 @@
+import sqlite3
+from pathlib import Path
+
+schema = '''
+CREATE TABLE IF NOT EXISTS torrents (
+    path TEXT PRIMARY KEY,
+    infohash TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    file_count INTEGER NOT NULL,
+    file_size INTEGER NOT NULL,
+    toc_html TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS torrents_infohash ON torrents (infohash);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dirty (
+    path TEXT PRIMARY KEY
+);
+'''
+
+columns = ['path', 'infohash', 'name', 'size', 'file_count', 'file_size', 'toc_html']
+
+# Bumped whenever the torrents table changes, older indexes are rebuilt
+schema_version = 2
+
+class TorrentIndex:
+    def __init__(self, db_path):
+        if db_path != ':memory:':
+            Path(db_path).parent.mkdir(exist_ok=True, parents=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] != schema_version:
+            self.conn.executescript('DROP TABLE IF EXISTS torrents; DROP TABLE IF EXISTS meta; DROP TABLE IF EXISTS dirty;')
+            self.conn.execute(f'PRAGMA user_version={schema_version}')
+        self.conn.executescript(schema)
+
+    def put(self, entry: dict):
+        self.conn.execute(
+            f'INSERT OR REPLACE INTO torrents ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})',
+            [entry[k] for k in columns],
+        )
+
+    def remove(self, path: str):
+        self.conn.execute('DELETE FROM torrents WHERE path = ?', (path,))
+
+    def clear(self):
+        self.conn.execute('DELETE FROM torrents')
+
+    def mark_dirty(self, path: str):
+        self.conn.execute('INSERT OR IGNORE INTO dirty (path) VALUES (?)', (path,))
+
+    def dirty(self):
+        return {row[0] for row in self.conn.execute('SELECT path FROM dirty')}
+
+    def clear_dirty(self):
+        self.conn.execute('DELETE FROM dirty')
+
+    def get_meta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def commit(self):
+        self.conn.commit()
+
+    def fingerprints(self):
+        # Torrents are named by infohash, so a path and size pin the content.
+        # mtimes are not used since every fresh checkout resets them.
+        cur = self.conn.execute('SELECT path, file_size FROM torrents')
+        return {row['path']: row['file_size'] for row in cur}
+
+    def infohashes(self):
+        return {row[0] for row in self.conn.execute('SELECT DISTINCT infohash FROM torrents')}
+
+    def all(self):
+        return self.conn.execute('SELECT * FROM torrents ORDER BY path').fetchall()
+
+    def under(self, rel_dir: str):
+        # '0' is the character right after '/', so this selects every path
+        # inside rel_dir and can still use the primary key
+        return self.conn.execute(
+            'SELECT * FROM torrents WHERE path > ? AND path < ? ORDER BY path',
+            (rel_dir + '/', rel_dir + '0'),
+        ).fetchall()
@@ -6,8 +6,22 @@ def get_parser():
     parser = ArgumentParser()
     parser.add_argument('-r', '--repo', type=Path, nargs=1, help='Path to repo')
     parser.add_argument('-w', '--watch', action='store_true', help='Whether to add torrents from watch dir')
+    parser.add_argument('-f', '--follow', action='store_true', help='Keep running and add torrents as they appear in watch dir')
     parser.add_argument('-t', '--transmission', required=False, type=str, help='Transmission rpc url')
     parser.add_argument('-d', '--download-url', required=False, type=str, help='Where to download torrents')
+    parser.add_argument('--download-threads', type=int, default=8, help='Number of concurrent torrent downloads')
+    parser.add_argument('-i', '--index', required=False, type=Path, help='Path to metadata index, defaults to ~/.cache/radar-torrent/REPO-HASH/index.sqlite')
+    import os
+    parser.add_argument('-j', '--jobs', type=int, default=len(os.sched_getaffinity(0)), help='Number of processes for parsing torrents')
+    parser.add_argument('--fold', type=int, help='Collapse directories with more than FOLD entries in TOCs')
+    parser.add_argument('--subpage', action='store_true', help='Write the full TOC of folded torrents to INFOHASH.md')
+    parser.add_argument('--max-readme-bytes', type=int, help='Split directory READMEs into README-2.md, ... beyond this size')
+    parser.add_argument('--meta-format', choices=['yaml', 'jsonl'], default='yaml', help='Format of metadata sidecar files')
+    parser.add_argument('--migrate-meta', action='store_true', help='Convert all .yml sidecar files to .jsonl and exit')
+    parser.add_argument('--verify-data', type=Path, help='Check local payloads under VERIFY_DATA against piece hashes and exit')
+    parser.add_argument('--verify-state', type=Path, help='Where to keep verification progress, defaults to ~/.cache/radar-torrent/REPO-HASH/verify')
+    parser.add_argument('--rebuild-index', action='store_true', help='Drop the metadata index and re-parse every torrent')
+    parser.add_argument('--verify-index', action='store_true', help='Check the metadata index against the torrent files and exit')
     return parser
 
 def size_repr(size):
@@ -19,149 +33,467 @@ def size_repr(size):
             size /= 1024
 
 class Tree:
+    __slots__ = ('name', 'son', 'size')
+
     def __init__(self, name):
         self.name = name
-        self.son = dict()
+        # None for files, so leaves do not carry an empty dict
+        self.son = None
         self.size = 0
 
-    def add_file(self, paths, size):
-        x = self
-        for v in paths:
+    @classmethod
+    def build(cls, name, files):
+        root = cls(name)
+        # stack[i] is the node of the first i components of the previous path
+        stack = [root]
+        last = ()
+        for paths, size in files:
+            common = 0
+            for a, b in zip(paths, last):
+                if a != b:
+                    break
+                common += 1
+            del stack[common + 1:]
+            x = stack[-1]
+            for v in paths[common:]:
+                if x.son is None:
+                    x.son = dict()
+                nxt = x.son.get(v)
+                if nxt is None:
+                    nxt = cls(v)
+                    x.son[v] = nxt
+                x = nxt
+                stack.append(x)
             x.size += size
-            nxt = x.son.get(v)
-            if nxt is None:
-                nxt = Tree(v)
-                x.son[v] = nxt
-            x = nxt
-        x.size += size
-
-    def gen_li(self, lines):
-        assert len(self.son) == 0
-        lines.append(f'<li>{self.name} <code title="{self.size}Bytes">{size_repr(self.size)}</code></li>')
-
-    def gen_html(self, lines):
-        assert len(self.son) > 0
+            last = paths
+        root.sum_sizes()
+        return root
+
+    def sum_sizes(self):
+        order = []
+        stack = [self]
+        while stack:
+            x = stack.pop()
+            order.append(x)
+            if x.son is not None:
+                stack.extend(x.son.values())
+        # Children always come after their parent in order
+        for x in reversed(order):
+            if x.son is not None:
+                x.size += sum(s.size for s in x.son.values())
+
+    def gen_li(self):
+        assert self.son is None
+        yield f'<li>{self.name} <code title="{self.size}Bytes">{size_repr(self.size)}</code></li>'
+
+    def need_fold(self, fold):
+        if fold is None or self.son is None:
+            return False
+        return len(self.son) > fold or any(s.need_fold(fold) for s in self.son.values())
+
+    def gen_html(self, fold=None, more_link=None):
+        assert self.son is not None
         dirs = []
         files = []
         for s in self.son.values():
-            if len(s.son) == 0:
+            if s.son is None:
                 files.append(s)
             else:
                 dirs.append(s)
-        lines.append('<details>')
-        lines.append(f'<summary>{self.name} <code>{size_repr(self.size)}</code></summary>')
-        lines.append('<ul>')
+        hidden = []
+        if fold is not None and len(dirs) + len(files) > fold:
+            hidden = (dirs + files)[fold:]
+            dirs = dirs[:fold]
+            files = files[:max(0, fold - len(dirs))]
+        yield '<details>'
+        yield f'<summary>{self.name} <code>{size_repr(self.size)}</code></summary>'
+        yield '<ul>'
         for d in dirs:
-            lines.append('<li>')
-            d.gen_html(lines)
-            lines.append('</li>')
+            yield '<li>'
+            yield from d.gen_html(fold, more_link)
+            yield '</li>'
         for f in files:
-            f.gen_li(lines)
-        lines.append('</ul>')
-        lines.append('</details>')
+            yield from f.gen_li()
+        if len(hidden) > 0:
+            more = f'… {len(hidden)} more'
+            if more_link is not None:
+                more = f'<a href="{more_link}">{more}</a>'
+            yield f'<li>{more} <code>{size_repr(sum(s.size for s in hidden))}</code></li>'
+        yield '</ul>'
+        yield '</details>'
 
 def mkwritable(path: Path):
     path.parent.mkdir(exist_ok=True, parents=True)
 
+def replace_atomic(path: Path, write):
+    import os
+    mkwritable(path)
+    # Workers can write the same torrent at once, so each has its own temp file
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+def write_if_changed(path: Path, content: str):
+    data = content.encode('utf-8')
+    if path.exists() and path.read_bytes() == data:
+        return False
+    replace_atomic(path, lambda f: f.write(data))
+    return True
+
+def parse_torrent(base_path: Path, torrent_path: Path, infohash=None, info=None, toc_options={}):
+    st = torrent_path.stat()
+    if info is None:
+        with open(torrent_path, 'rb') as f:
+            data, infohash = TorrentRepo.decode_torrent(f.read())
+        info = data['info']
+    assert infohash == torrent_path.stem
+    rel_path = torrent_path.relative_to(base_path)
+    # Links in a directory README are relative to the top-level directory
+    torrent_link = Path(*rel_path.parts[1:]).as_posix() if len(rel_path.parts) > 1 else rel_path.name
+    root = TorrentRepo.gen_toc_tree(info, torrent_link)
+    fold = toc_options.get('fold')
+    subpage_path = torrent_path.with_suffix('.md')
+    more_link = None
+    if toc_options.get('subpage') and root.need_fold(fold):
+        more_link = Path(torrent_link).with_suffix('.md').as_posix()
+        subpage = TorrentRepo.gen_toc_tree(info, torrent_path.name)
+        write_if_changed(subpage_path, f'# {info["name"]}\n' + '\n'.join(subpage.gen_html()))
+    else:
+        subpage_path.unlink(missing_ok=True)
+    return {
+        'path': rel_path.as_posix(),
+        'infohash': infohash,
+        'name': info['name'],
+        'size': sum(it['length'] for it in info['files']),
+        'file_count': len(info['files']),
+        'file_size': st.st_size,
+        'toc_html': '\n'.join(root.gen_html(fold, more_link)),
+    }
+
+def write_torrent(base_path: Path, file_content, rel_path=Path('.'), toc_options={}):
+    from bencode import encode_to
+    data, infohash = TorrentRepo.decode_torrent(file_content)
+    file_path = base_path / rel_path / infohash
+    replace_atomic(file_path.with_suffix('.torrent'), lambda f: encode_to({'info': data['info']}, f))
+    entry = parse_torrent(base_path, file_path.with_suffix('.torrent'), infohash, data['info'], toc_options)
+    del data['info']
+    return entry, data
+
+def ingest_torrent(base_path: Path, torrent_path: Path, rel_path: Path, toc_options={}):
+    with open(torrent_path, 'rb') as f:
+        return write_torrent(base_path, f.read(), rel_path, toc_options)
+
 class TorrentRepo:
-    def __init__(self, base_path: Path):
+    def __init__(self, base_path: Path, index_path=None, jobs=1, toc_options={}, max_readme_bytes=None, meta_format='yaml'):
         self.path = base_path
+        self.meta_format = meta_format
+        self.jobs = jobs
+        self.toc_options = toc_options
+        self.max_readme_bytes = max_readme_bytes
         self.watch_dir = self.path / 'watch'
+        if index_path is None:
+            index_path = self.cache_dir / 'index.sqlite'
+        from index import TorrentIndex
+        self.index = TorrentIndex(index_path)
 
     @staticmethod
-    def get_infohash(info):
+    def decode_torrent(file_content):
         import hashlib
-        from bencode import bencode
-        return hashlib.sha1(bencode(info)).hexdigest()
+        from bencode import bdecode_span, bencode
+        data, span, canonical = bdecode_span(file_content, 'info')
+        if span is None:
+            raise ValueError('torrent has no info dict')
+        info_raw = memoryview(file_content)[span[0]:span[1]]
+        # Unsorted keys outside the info dict do not affect its hash
+        if not canonical and bencode(data['info']) != info_raw:
+            print('Warning: info dict is not canonically encoded, hashing re-encoded copy')
+            info_raw = bencode(data['info'])
+        return data, hashlib.sha1(info_raw).hexdigest()
 
     def add_raw_torrent(self, file_content, rel_path=Path('.')):
-        from bencode import bdecode, bencode
-        data = bdecode(file_content)
-        infohash = self.get_infohash(data['info'])
-        file_path = self.path / rel_path / infohash
-        mkwritable(file_path)
-        with open(file_path.with_suffix('.torrent'), 'wb') as f:
-            f.write(bencode({'info': data['info']}))
-        meta_path = file_path.with_suffix('.yml')
-        meta = []
-        if meta_path.exists():
-            with open(meta_path, 'r') as f:
-                import yaml
-                from yaml import Loader
-                meta += yaml.load(f, Loader=Loader)
-        del data['info']
-        if not any(t == data for t in meta):
-            meta.append(data)
-        mkwritable(meta_path)
-        with open(meta_path, 'w') as f:
-            import yaml
-            yaml.dump(list(meta), f, allow_unicode=True)
-
-    def scan_watch(self, watch_path=None):
+        self.add_entry(*write_torrent(self.path, file_content, rel_path, self.toc_options))
+        self.index.commit()
+
+    def add_entry(self, entry: dict, data: dict):
+        self.put_entry(entry)
+        from meta import MetaStore
+        MetaStore(self.meta_format).add((self.path / entry['path']).with_suffix(''), data)
+
+    def migrate_meta(self):
+        from meta import MetaStore
+        count = 0
+        for path in self.iter_torrent_files():
+            if MetaStore.migrate(path.with_suffix('')):
+                count += 1
+        return count
+
+    def scan_watch(self, watch_path=None, files=None, keep_going=False):
         if watch_path is None:
             watch_path = self.watch_dir
-        if not watch_path.exists():
-            return
+        if files is None:
+            if not watch_path.exists():
+                return 0
+            from watcher import list_torrents
+            files = list(list_torrents(watch_path))
+        files = [p for p in dict.fromkeys(files) if p.exists()]
+        args = [(self.path, p, p.parent.relative_to(watch_path), self.toc_options) for p in files]
+        if self.jobs > 1 and len(files) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            exe = ProcessPoolExecutor(min(self.jobs, len(files)))
+            results = [exe.submit(ingest_torrent, *t) for t in args]
+        else:
+            exe = None
+            results = args
+        added = 0
+        try:
+            for p, res in zip(files, results):
+                try:
+                    entry, data = ingest_torrent(*res) if exe is None else res.result()
+                except Exception as e:
+                    if not keep_going:
+                        raise
+                    print(f'Failed to add {p}: {e!r}')
+                    continue
+                self.add_entry(entry, data)
+                p.unlink()
+                added += 1
+        finally:
+            self.index.commit()
+            if exe is not None:
+                exe.shutdown(cancel_futures=True)
+        return added
+
+    def follow_watch(self, debounce=0.5):
+        import time
+        from watcher import create_watcher
+        watcher = create_watcher(self.watch_dir)
+        print(f'Following {self.watch_dir} with {type(watcher).__name__}')
+        try:
+            self.scan_watch(keep_going=True)
+            self.report_readmes(*self.update_readmes())
+            while True:
+                batch = watcher.wait()
+                # Collect files dropped shortly after each other into one batch
+                while True:
+                    more = watcher.wait(debounce)
+                    if not more:
+                        break
+                    batch += more
+                start = time.monotonic()
+                added = self.scan_watch(files=batch, keep_going=True)
+                if added > 0:
+                    self.report_readmes(*self.update_readmes())
+                    print(f'Added {added} torrent(s) in {time.monotonic() - start:.2f}s')
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+
+    @staticmethod
+    def gen_toc_tree(info, torrent_link: str):
+        return Tree.build(
+            f'<a href="{torrent_link}">{info["name"]}</a>',
+            ((it['path'], it['length']) for it in info['files']),
+        )
+
+    @property
+    def cache_dir(self):
+        # Local state stays out of the data repo, which workflows commit with git add -A
+        import hashlib
+        path = self.path.resolve()
+        key = hashlib.sha1(str(path).encode('utf-8')).hexdigest()[:12]
+        return Path.home() / '.cache' / 'radar-torrent' / f'{path.name}-{key}'
+
+    def put_entry(self, entry: dict):
+        self.index.mark_dirty(entry['path'])
+        self.index.put(entry)
+
+    def is_skipped_dir(self, name):
+        # Top-level directories that never hold indexed torrents
+        return name.startswith('.') or name == self.watch_dir.name
+
+    def iter_torrent_files(self):
         import os
-        for root, dirs, files in os.walk(watch_path):
+        for root, dirs, files in os.walk(self.path):
             root = Path(root)
+            if root == self.path:
+                dirs[:] = [d for d in dirs if not self.is_skipped_dir(d)]
             for name in files:
                 if name.endswith('.torrent'):
-                    with open(root / name, 'rb') as f:
-                        self.add_raw_torrent(f.read(), root.relative_to(watch_path))
-                    (root / name).unlink()
+                    yield root / name
+
+    def sync_index(self, rebuild=False):
+        import json
+        # Stored TOCs depend on how they were rendered
+        render_options = json.dumps([self.toc_options, self.max_readme_bytes], sort_keys=True)
+        if self.index.get_meta('render_options') != render_options:
+            rebuild = True
+        if rebuild:
+            self.index.clear()
+            self.index.set_meta('render_options', render_options)
+        known = self.index.fingerprints()
+        changed = []
+        for path in self.iter_torrent_files():
+            rel_path = path.relative_to(self.path).as_posix()
+            st = path.stat()
+            if known.pop(rel_path, None) != st.st_size:
+                changed.append(path)
+        from itertools import repeat
+        if self.jobs > 1 and len(changed) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(self.jobs) as exe:
+                chunksize = max(1, len(changed) // (self.jobs * 4))
+                for entry in exe.map(
+                    parse_torrent, repeat(self.path), changed, repeat(None), repeat(None), repeat(self.toc_options),
+                    chunksize=chunksize,
+                ):
+                    self.put_entry(entry)
+        else:
+            for entry in map(parse_torrent, repeat(self.path), changed, repeat(None), repeat(None), repeat(self.toc_options)):
+                self.put_entry(entry)
+        for rel_path in known:
+            self.index.remove(rel_path)
+            (self.path / rel_path).with_suffix('.md').unlink(missing_ok=True)
+            self.index.mark_dirty(rel_path)
+        self.index.commit()
+
+    def verify_index(self):
+        problems = 0
+        known = {row['path']: row for row in self.index.all()}
+        for path in self.iter_torrent_files():
+            rel_path = path.relative_to(self.path).as_posix()
+            row = known.pop(rel_path, None)
+            if row is None:
+                print(f'Not indexed: {rel_path}')
+                problems += 1
+                continue
+            st = path.stat()
+            if row['file_size'] != st.st_size:
+                print(f'Stale: {rel_path}')
+                problems += 1
+            with open(path, 'rb') as f:
+                infohash = self.decode_torrent(f.read())[1]
+            if infohash != row['infohash'] or infohash != path.stem:
+                print(f'Infohash mismatch: {rel_path}')
+                problems += 1
+        for rel_path in known:
+            print(f'Missing file: {rel_path}')
+            problems += 1
+        return problems
+
+    @staticmethod
+    def readme_name(page):
+        return 'README.md' if page == 0 else f'README-{page + 1}.md'
 
-    def gen_toc_html(self, torrent_path: Path, torrent_link: str):
+    def verify_data(self, data_dir: Path, state_dir=None):
         from bencode import bdecode
-        with open(torrent_path, 'rb') as f:
-            info = bdecode(f.read())['info']
-        assert self.get_infohash(info) == torrent_path.stem
-        root = Tree(f'<a href="{torrent_link}">{info["name"]}</a>')
-        for it in info['files']:
-            root.add_file(it['path'], it['length'])
-        lines = []
-        root.gen_html(lines)
-        return '\n'.join(lines)
+        from verify import verify_torrent
+        if state_dir is None:
+            state_dir = self.cache_dir / 'verify'
+        problems = 0
+        for row in self.index.all():
+            torrent_path = self.path / row['path']
+            with open(torrent_path, 'rb') as f:
+                info = bdecode(f.read())['info']
+            # Payloads are laid out like the repo, as in Transmission's download dir
+            payload_dir = data_dir / Path(row['path']).parent
+            result = verify_torrent(info, payload_dir, self.jobs, state_dir / f'{row["infohash"]}.json')
+            if result['bad'] > 0 or result['missing'] > 0:
+                problems += 1
+                print(f'FAIL {row["path"]} {row["name"]}: {result["bad"]} bad, {result["missing"]} missing, {result["good"]} good')
+            else:
+                print(f'OK   {row["path"]} {row["name"]}')
+        return problems
 
-    def gen_dir_html(self, abs_path: Path):
-        import os
-        lines = []
-        for root, dirs, files in os.walk(abs_path):
-            root = Path(root)
-            rel_path = root.relative_to(abs_path)
-            first = True
-            for name in sorted(files):
-                if not name.endswith('.torrent'):
-                    continue
-                if first:
-                    first = False
-                    if root != abs_path:
-                        lines.append(f'<h2>{rel_path.as_posix()}</h2>')
-                lines.append(self.gen_toc_html(root / name, (rel_path / name).as_posix()))
-        return '\n'.join(lines)
+    def gen_dir_pages(self, abs_path: Path):
+        top = abs_path.relative_to(self.path)
+        entries = []
+        for row in self.index.under(top.as_posix()):
+            rel_path = Path(row['path']).relative_to(top)
+            entries.append((rel_path.parent.parts, rel_path.name, row['toc_html']))
+        # Same order as a top-down walk with sorted names
+        entries.sort()
+        pages = [[]]
+        page_bytes = 0
+        last_dir = None
+        for parts, name, toc_html in entries:
+            toc_bytes = len(toc_html.encode('utf-8')) + 1
+            if self.max_readme_bytes is not None and len(pages[-1]) > 0 and page_bytes + toc_bytes > self.max_readme_bytes:
+                pages.append([])
+                page_bytes = 0
+                last_dir = None
+            if parts != last_dir:
+                last_dir = parts
+                if len(parts) > 0:
+                    heading = f'<h2>{Path(*parts).as_posix()}</h2>'
+                    pages[-1].append(heading)
+                    page_bytes += len(heading.encode('utf-8')) + 1
+            pages[-1].append(toc_html)
+            page_bytes += toc_bytes
+        for i, lines in enumerate(pages[:-1]):
+            lines.append(f'<a href="./{self.readme_name(i + 1)}">Next page</a>')
+        return ['\n'.join(lines) for lines in pages]
+
+    def update_readmes(self):
+        self.path.mkdir(exist_ok=True, parents=True)
+        # Dirty paths live in the index so a run that fails before this point
+        # still regenerates their READMEs next time
+        dirty = self.index.dirty()
+        dirty_dirs = {Path(t).parts[0] for t in dirty}
+        updated = []
+        skipped = 0
+        for p in self.path.iterdir():
+            if not p.is_dir():
+                continue
+            if self.is_skipped_dir(p.name):
+                continue
+            readme_path = p / 'README.md'
+            if p.name not in dirty_dirs and readme_path.exists():
+                skipped += 1
+                continue
+            pages = self.gen_dir_pages(p)
+            for i, content in enumerate(pages):
+                page_path = p / self.readme_name(i)
+                if write_if_changed(page_path, content):
+                    updated.append(page_path)
+            for page_path in p.glob('README-*.md'):
+                if page_path.name not in {self.readme_name(i) for i in range(len(pages))}:
+                    page_path.unlink()
+        readme_path = self.path / 'README.md'
+        if len(dirty) > 0 or not readme_path.exists():
+            if write_if_changed(readme_path, '# Torrents\n' + self.gen_all_torrent_html()):
+                updated.append(readme_path)
+        self.index.clear_dirty()
+        self.index.commit()
+        return len(dirty), updated, skipped
+
+    def report_readmes(self, changed, updated, skipped):
+        print(f'{changed} torrent(s) changed, {len(updated)} README(s) updated, {skipped} directory(s) unchanged')
+        for p in updated:
+            print(f'Updated {p.relative_to(self.path).as_posix()}')
 
     def all_torrent_infohash(self):
-        infohash = set()
+        infohash = self.index.infohashes()
         import os
-        for root, dirs, files in os.walk(self.path):
+        # Torrents that are fetched but not yet added
+        for root, dirs, files in os.walk(self.watch_dir):
             for name in files:
-                if not name.endswith('.torrent'):
-                    continue
-                infohash.add(Path(name).stem)
+                if name.endswith('.torrent'):
+                    infohash.add(Path(name).stem)
         return list(infohash)
 
     def gen_all_torrent_html(self):
         lines = []
-        def dfs1(path: Path):
+        def dfs1():
             ret = dict()
-            for t in path.iterdir():
-                v = t
-                if t.is_dir():
-                    v = dfs1(t)
-                elif t.suffix != '.torrent':
-                    v = None
-                if v is not None:
-                    ret[t.name] = v
+            rows = sorted(self.index.all(), key=lambda row: Path(row['path']).parts)
+            for row in rows:
+                *parts, name = Path(row['path']).parts
+                cur = ret
+                for t in parts:
+                    cur = cur.setdefault(t, dict())
+                cur[name] = row
             if len(ret) > 0:
                 return ret
         def dfs2(entries):
@@ -180,18 +512,40 @@ class TorrentRepo:
                         lines.append('</ul></li>')
                     else:
                         dfs2(v)
-            else:
-                path: Path = entries
-                with open(path, 'rb') as f:
-                    from bencode import bdecode
-                    info = bdecode(f.read())['info']
-                lines.append(f'<li><a href="{path.relative_to(self.path)}">{info["name"]}</a> <code>{path.stem}</code></li>')
+            elif entries is not None:
+                row = entries
+                lines.append(f'<li><a href="{row["path"]}">{row["name"]}</a> <code>{row["infohash"]}</code></li>')
         lines.append('<ul>')
-        dfs2(dfs1(self.path))
+        dfs2(dfs1())
         lines.append('</ul>')
         return '\n'.join(lines)
 
-    def download_from_transmission(self, rpc_url, dl_url):
+    @staticmethod
+    def create_session(threads):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        session = requests.Session()
+        retry = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=threads, max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def fetch_torrent(self, session, url, infohash, save_path: Path):
+        res = session.get(url, timeout=60)
+        res.raise_for_status()
+        assert len(res.content) > 0
+        assert self.decode_torrent(res.content)[1] == infohash
+        mkwritable(save_path)
+        # Not ending with .torrent so that scan_watch never sees partial files
+        tmp_path = save_path.with_suffix('.part')
+        with open(tmp_path, 'wb') as f:
+            f.write(res.content)
+        import os
+        os.replace(tmp_path, save_path)
+
+    def download_from_transmission(self, rpc_url, dl_url, threads=8):
         from transmission_rpc import Client
         from urllib.parse import urlparse
         rpc_info = urlparse(rpc_url)
@@ -204,19 +558,26 @@ class TorrentRepo:
             port=rpc_info.port or 9091,
         )
         local = set(self.all_torrent_infohash())
-        torrents = c.get_torrents()
+        torrents = c.get_torrents(arguments=['id', 'hashString', 'downloadDir'])
         torrents = {t.hashString.lower(): t for t in torrents}
         remote = set(torrents)
-        for infohash in remote.difference(local):
-            import requests
-            from urllib.parse import urljoin
-            save_path = self.watch_dir / Path(torrents[infohash].download_dir).relative_to('/downloads') / f'{infohash}.torrent'
-            mkwritable(save_path)
-            with open(save_path, 'wb') as f:
-                res = requests.get(urljoin(dl_url, f'{infohash}.torrent'))
-                assert res.ok
-                assert len(res.content) > 0
-                f.write(res.content)
+        missing = sorted(remote.difference(local))
+        from urllib.parse import urljoin
+        from concurrent.futures import ThreadPoolExecutor
+        failed = []
+        with self.create_session(threads) as session, ThreadPoolExecutor(threads) as exe:
+            futures = {}
+            for infohash in missing:
+                save_path = self.watch_dir / Path(torrents[infohash].download_dir).relative_to('/downloads') / f'{infohash}.torrent'
+                url = urljoin(dl_url, f'{infohash}.torrent')
+                futures[infohash] = exe.submit(self.fetch_torrent, session, url, infohash, save_path)
+            for infohash, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    failed.append(infohash)
+                    print(f'Failed to download {infohash}: {e!r}')
+        print(f'Downloaded {len(missing) - len(failed)} of {len(missing)} torrent(s)')
         unused = local.difference(remote)
         if len(unused) > 0:
             print('Torrents not present in remote:')
@@ -225,23 +586,29 @@ class TorrentRepo:
 
 def main():
     args = get_parser().parse_args()
-    repo = TorrentRepo(args.repo[0])
+    toc_options = {'fold': args.fold, 'subpage': args.subpage}
+    repo = TorrentRepo(args.repo[0], args.index, args.jobs, toc_options, args.max_readme_bytes, args.meta_format)
+    if args.migrate_meta:
+        print(f'Migrated {repo.migrate_meta()} sidecar file(s)')
+        return
+    if args.verify_index:
+        problems = repo.verify_index()
+        print(f'{problems} problem(s) found')
+        exit(1 if problems > 0 else 0)
+    repo.sync_index(rebuild=args.rebuild_index)
+    if args.verify_data is not None:
+        problems = repo.verify_data(args.verify_data, args.verify_state)
+        print(f'{problems} torrent(s) failed verification')
+        exit(1 if problems > 0 else 0)
     if args.transmission is not None:
         assert args.download_url is not None
-        repo.download_from_transmission(args.transmission, args.download_url)
+        repo.download_from_transmission(args.transmission, args.download_url, args.download_threads)
     if args.watch:
         repo.scan_watch()
-    repo.path.mkdir(exist_ok=True, parents=True)
-    for p in repo.path.iterdir():
-        if not p.is_dir():
-            continue
-        if p.name == '.git':
-            continue
-        with open(p / 'README.md', 'w') as f:
-            f.write(repo.gen_dir_html(p))
-    with open(repo.path / 'README.md', 'w') as f:
-        f.write('# Torrents\n')
-        f.write(repo.gen_all_torrent_html())
+    if args.follow:
+        repo.follow_watch()
+        return
+    repo.report_readmes(*repo.update_readmes())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,89 @@
+import json
+from pathlib import Path
+
+try:
+    from yaml import CLoader as Loader, CDumper as Dumper
+except ImportError:
+    from yaml import Loader, Dumper
+
+def json_default(x):
+    if isinstance(x, (bytes, memoryview)):
+        import base64
+        return {'$bytes': base64.b64encode(x).decode('ascii')}
+    raise TypeError(f'Cannot serialize {type(x)}')
+
+def json_object_hook(x):
+    if len(x) == 1 and '$bytes' in x:
+        import base64
+        return base64.b64decode(x['$bytes'])
+    return x
+
+def dump_line(entry):
+    return json.dumps(entry, sort_keys=True, ensure_ascii=False, default=json_default) + '\n'
+
+def load_yaml(path: Path):
+    import yaml
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=Loader) or []
+
+def load_jsonl(path: Path):
+    with open(path, 'r') as f:
+        return [json.loads(line, object_hook=json_object_hook) for line in f if line.strip()]
+
+def write_atomic(path: Path, content: str):
+    path.parent.mkdir(exist_ok=True, parents=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    import os
+    os.replace(tmp_path, path)
+
+class MetaStore:
+    formats = ['yaml', 'jsonl']
+
+    def __init__(self, fmt='yaml'):
+        assert fmt in self.formats
+        self.fmt = fmt
+
+    def add(self, base_path: Path, entry: dict):
+        # Once a sidecar is in jsonl it stays there, whatever the format
+        if self.fmt == 'jsonl' or base_path.with_suffix('.jsonl').exists():
+            self.migrate(base_path)
+            self.add_jsonl(base_path.with_suffix('.jsonl'), entry)
+        else:
+            self.add_yaml(base_path.with_suffix('.yml'), entry)
+
+    @staticmethod
+    def add_yaml(path: Path, entry: dict):
+        meta = load_yaml(path) if path.exists() else []
+        if entry in meta:
+            return
+        meta.append(entry)
+        import yaml
+        write_atomic(path, yaml.dump(meta, Dumper=Dumper, allow_unicode=True))
+
+    @staticmethod
+    def add_jsonl(path: Path, entry: dict):
+        line = dump_line(entry)
+        if path.exists():
+            with open(path, 'r') as f:
+                if line in set(f):
+                    return
+        path.parent.mkdir(exist_ok=True, parents=True)
+        with open(path, 'a') as f:
+            f.write(line)
+
+    @staticmethod
+    def migrate(base_path: Path):
+        yml_path = base_path.with_suffix('.yml')
+        if not yml_path.exists():
+            return False
+        jsonl_path = base_path.with_suffix('.jsonl')
+        entries = load_jsonl(jsonl_path) if jsonl_path.exists() else []
+        entries += load_yaml(yml_path)
+        lines = dict()
+        for entry in entries:
+            lines.setdefault(dump_line(entry), None)
+        write_atomic(jsonl_path, ''.join(lines))
+        yml_path.unlink()
+        return True
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+def file_list(info):
+    if 'files' in info:
+        return [(Path(info['name'], *it['path']), it['length']) for it in info['files']]
+    return [(Path(info['name']), info['length'])]
+
+def hash_piece(segments):
+    h = hashlib.sha1()
+    for s in segments:
+        h.update(s)
+    return h.digest()
+
+class PieceReader:
+    def __init__(self, data_dir: Path, info):
+        self.files = []
+        offset = 0
+        for rel_path, length in file_list(info):
+            self.files.append((data_dir / rel_path, offset, length))
+            offset += length
+        self.total = offset
+        self.maps = dict()
+        self.cur = 0
+
+    def fingerprint(self):
+        ret = []
+        for path, offset, length in self.files:
+            try:
+                st = path.stat()
+                ret.append([path.as_posix(), st.st_size, st.st_mtime_ns])
+            except FileNotFoundError:
+                ret.append([path.as_posix(), None, None])
+        return ret
+
+    def open(self, i):
+        if i not in self.maps:
+            path, offset, length = self.files[i]
+            m = None
+            try:
+                with open(path, 'rb') as f:
+                    if os.fstat(f.fileno()).st_size == length:
+                        import mmap
+                        m = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            except FileNotFoundError:
+                pass
+            self.maps[i] = m
+        return self.maps[i]
+
+    def segments(self, start, end):
+        # Pieces are read in order, so files before the current one can be
+        # dropped; the mapping closes once no pending piece refers to it
+        while self.cur < len(self.files) and self.files[self.cur][1] + self.files[self.cur][2] <= start:
+            self.maps.pop(self.cur, None)
+            self.cur += 1
+        ret = []
+        i = self.cur
+        while start < end:
+            path, offset, length = self.files[i]
+            if length > 0:
+                m = self.open(i)
+                if m is None:
+                    return None
+                seg_end = min(end, offset + length)
+                ret.append(m[start - offset:seg_end - offset])
+                start = seg_end
+            i += 1
+        return ret
+
+def load_state(state_path, fingerprint, num_pieces):
+    if state_path is not None and state_path.exists():
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+        if state['fingerprint'] == fingerprint:
+            return bytearray.fromhex(state['good'])
+    return bytearray((num_pieces + 7) // 8)
+
+def save_state(state_path, fingerprint, good):
+    if state_path is None:
+        return
+    state_path.parent.mkdir(exist_ok=True, parents=True)
+    tmp_path = state_path.with_name(state_path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'good': good.hex()}, f)
+    os.replace(tmp_path, state_path)
+
+def verify_torrent(info, data_dir: Path, threads=1, state_path=None):
+    import time
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    piece_length = info['piece length']
+    pieces = info['pieces']
+    num_pieces = len(pieces) // 20
+    reader = PieceReader(data_dir, info)
+    assert (reader.total + piece_length - 1) // piece_length == num_pieces
+    fingerprint = reader.fingerprint()
+    good = load_state(state_path, fingerprint, num_pieces)
+    result = {'good': 0, 'bad': 0, 'missing': 0}
+    last_save = time.monotonic()
+
+    def finish(i, digest):
+        nonlocal last_save
+        if digest is None:
+            result['missing'] += 1
+        elif digest == pieces[i * 20:(i + 1) * 20]:
+            good[i >> 3] |= 1 << (i & 7)
+            result['good'] += 1
+        else:
+            result['bad'] += 1
+        if time.monotonic() - last_save > 10:
+            save_state(state_path, fingerprint, good)
+            last_save = time.monotonic()
+
+    # hashlib releases the GIL on large buffers, so threads hash in parallel
+    with ThreadPoolExecutor(threads) as exe:
+        pending = deque()
+        try:
+            for i in range(num_pieces):
+                if good[i >> 3] & (1 << (i & 7)):
+                    result['good'] += 1
+                    continue
+                start = i * piece_length
+                segments = reader.segments(start, min(start + piece_length, reader.total))
+                if segments is None:
+                    finish(i, None)
+                    continue
+                pending.append((i, exe.submit(hash_piece, segments)))
+                while len(pending) > threads * 4:
+                    j, future = pending.popleft()
+                    finish(j, future.result())
+            while pending:
+                j, future = pending.popleft()
+                finish(j, future.result())
+        finally:
+            for j, future in pending:
+                future.cancel()
+            save_state(state_path, fingerprint, good)
+    return result
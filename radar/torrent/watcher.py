@@ -0,0 +1,137 @@
+import os
+from pathlib import Path
+
+def list_torrents(path: Path):
+    for root, dirs, files in os.walk(path):
+        root = Path(root)
+        for name in files:
+            if name.endswith('.torrent'):
+                yield root / name
+
+class PollWatcher:
+    def __init__(self, path: Path, interval=1.0):
+        self.path = path
+        self.interval = interval
+        self.known = dict()
+        self.pending = dict()
+
+    def poll(self):
+        found = dict()
+        for p in list_torrents(self.path):
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            found[p] = (st.st_mtime_ns, st.st_size)
+        ready = []
+        pending = dict()
+        for p, fp in found.items():
+            if self.known.get(p) == fp:
+                continue
+            # Only report files that did not change between two polls,
+            # so that files still being written are left for later
+            if self.pending.get(p) == fp:
+                ready.append(p)
+                self.known[p] = fp
+            else:
+                pending[p] = fp
+        self.pending = pending
+        for p in set(self.known).difference(found):
+            del self.known[p]
+        return ready
+
+    def wait(self, timeout=None):
+        import time
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            ready = self.poll()
+            if ready or (deadline is not None and time.monotonic() >= deadline):
+                return ready
+            time.sleep(self.interval if deadline is None else max(0, min(self.interval, deadline - time.monotonic())))
+
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, path: Path):
+        import ctypes
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.path = path
+        self.dirs = dict()
+        self.overflow = []
+        self.add_tree(path)
+
+    def add_dir(self, path: Path):
+        import ctypes
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed on {path}')
+        self.dirs[wd] = path
+
+    def add_tree(self, path: Path):
+        # Files created before the watch was in place are reported directly
+        found = []
+        for root, dirs, files in os.walk(path):
+            self.add_dir(Path(root))
+            found += (Path(root) / name for name in files if name.endswith('.torrent'))
+        return found
+
+    def read_events(self):
+        import struct
+        changed = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changed
+            f = 0
+            while f < len(buf):
+                wd, mask, cookie, length = struct.unpack_from('iIII', buf, f)
+                f += 16
+                name = os.fsdecode(buf[f:f + length].rstrip(b'\0'))
+                f += length
+                if mask & self.IN_Q_OVERFLOW:
+                    changed += list_torrents(self.path)
+                    continue
+                if mask & self.IN_IGNORED:
+                    self.dirs.pop(wd, None)
+                    continue
+                if wd not in self.dirs:
+                    continue
+                p = self.dirs[wd] / name
+                if mask & self.IN_ISDIR:
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        changed += self.add_tree(p)
+                elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO) and name.endswith('.torrent'):
+                    changed.append(p)
+
+    def wait(self, timeout=None):
+        import select
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        if not r:
+            return []
+        return self.read_events()
+
+    def close(self):
+        os.close(self.fd)
+
+def create_watcher(path: Path):
+    path.mkdir(exist_ok=True, parents=True)
+    import sys
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(path)
+        except (OSError, AttributeError):
+            pass
+    return PollWatcher(path)